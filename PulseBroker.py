@@ -22,6 +22,33 @@
                             default: None (i.e. Mozilla's Pulse)
         -t --topic          Pulse topic string
                             default: #
+        -w --window         How many jobs each server can have in-flight
+                            default: 10
+           --batchsize      Most jobs sent to a server in one message
+                            default: 50
+           --batchtime      Milliseconds a partial batch waits for more jobs
+                            default: 10
+           --events         ZeroMQ address jobs are handed to the dispatcher on,
+                            an ipc socket that already exists is refused
+                            default: ipc://<spoolpath>/pulsebroker.<pid>.ipc
+           --spoolpath      Path where undeliverable jobs are spooled
+                            default: .
+           --policy         How jobs are spread across servers: hash, leastload or first
+                            default: hash
+           --pulsearchive   Path where complete Pulse messages are archived,
+                            jobs sent to servers only carry the fields they use
+                            default: None
+           --testfile       Offline testing, replay the named bpServer archive
+                            files (comma separated) instead of listening to Pulse,
+                            indexed .blk archives and plain json-lines ones
+                            default: None
+           --speed          How fast --testfile is replayed: 1 for the original
+                            timing, N for N times as fast, 0 for as fast as
+                            the servers will take it
+                            default: 0
+           --dedupe         Seconds a Pulse message id is remembered so
+                            redelivered messages are dropped, 0 to disable
+                            default: 900
         -d --debug          Turn on debug logging
                             default: False
         -l --logpath        Path where the log file output is written
@@ -33,59 +60,266 @@
 
         { 'redis': 'localhost:6379',
           'debug': True,
-          'logpath': '.'
+          'logpath': '.',
+          'policy': 'leastload'
         }
 
     Authors:
         bear    Mike Taylor <bear@mozilla.com>
 """
 
-import os
+import os, sys
 import json
 import time
 
-from Queue import Empty
-from multiprocessing import Process, Queue, get_logger
+from datetime import datetime
+
+from multiprocessing import Process, get_logger
 
 import zmq
 
 from releng import initOptions, initLogs, dbRedis
-from releng.constants import ID_PULSE_WORKER
+from releng.wire import WIRE_JSON, WIRE_KEYS, formats, preferred, encodeJob, decodeJob, transcodeJob, routeKey
+from releng.spool import Spool
+from releng.archive import ArchiveReader
+from releng.hashring import HashRing
+from releng.timers import TimerWheel
+from releng.isotime import parseTimestamp
+from releng.dedupe import Dedupe, DEDUPE_WINDOW
+from releng.constants import ID_PULSE_WORKER, PULSE_PROPERTIES
 
 from mozillapulse import consumers
 
 
-appInfo    = 'bear@mozilla.com|briar-patch'
-log        = get_logger()
-eventQueue = Queue()
+appInfo      = 'bear@mozilla.com|briar-patch'
+log          = get_logger()
+eventSocket  = None
+pulseArchive = None
+dedupe       = None
+replayStats  = None
 
 SERVER_CHECK_INTERVAL = 120  # how often, in minutes, to check for new servers
 PING_FAIL_MAX         = 1    # how many pings can fail before server is marked inactive
 PING_INTERVAL         = 120  # ping servers every 2 minutes
 MSG_TIMEOUT           = 120  # 2 minutes until a pending message is considered expired
+MSG_RETRIES           = 2    # how many times an expired message is resent before it is dropped
+MSG_WINDOW            = 10   # how many messages a server can have in-flight
+BATCH_SIZE            = 50   # most jobs coalesced into a single message
+BATCH_TIME            = 10   # milliseconds a partial batch waits for more jobs
+QUEUE_DEPTH           = 2    # how many batches can queue for a server on top of its window
+LATENCY_ALPHA         = 0.2  # weight given to the newest sample in the reply latency average
+LATENCY_DEFAULT       = 0.01 # seconds, assumed reply latency until a server has been measured
+TIMER_TICK            = 1    # timer wheel resolution, in seconds
+SPOOL_SYNC            = 1    # how often, in seconds, spooled jobs are fsync'd
+DEDUPE_REPORT         = 1000 # Pulse messages between dedupe counter reports
+BUSY_BACKOFF          = 1    # seconds a server that replied busy is sent nothing
 
 
 def OfflineTest(options):
+    """ OfflineTest
+    Replay bpServer archive files through the dispatcher.
+
+    With options.speed at 0 jobs are pushed as fast as the dispatcher
+    will take them, otherwise the gaps between the job timestamps are
+    kept, divided by options.speed.  Each job is stamped when it is
+    pushed so handleZMQ can report jobs/sec and the push to
+    acknowledgement latency once the last of them is acknowledged.
+    """
     log.info('Starting Offline message testing')
 
-    hArchive = open(options.testfile, 'r+')
+    try:
+        speed = float(options.speed)
+    except:
+        log.error('invalid speed value [%s] - replaying as fast as possible' % options.speed)
+        speed = 0
 
-    for msg in hArchive:
-        job = json.loads(msg)
-        pushJob(job)
+    origin = None   # (wall clock, job time) of the first job
+    count  = 0
+    start  = time.time()
+
+    for filename in options.testfile.split(','):
+        log.info('replaying %s' % filename)
+
+        for job in ArchiveReader(filename).jobs():
+            # older archives carry the complete Pulse message
+            if '_meta' in job['pulse']:
+                job['pulse'] = projectPulse(job['pulse_key'].split('.')[0], job['pulse'])
+
+            if speed > 0:
+                try:
+                    ts = parseTimestamp(job['time']).epoch
+                except:
+                    ts = None
 
-    hArchive.close()
+                if ts is not None:
+                    if origin is None:
+                        origin = (time.time(), ts)
 
+                    delay = origin[0] + ((ts - origin[1]) / speed) - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+
+            pushJob(job, stamp=time.time())
+            count += 1
+
+    elapsed = time.time() - start
+    log.info('replayed %d jobs in %0.2fs' % (count, elapsed))
+
+    eventSocket.send_multipart(['report'])
+
+
+class ReplayStats(object):
+    """Latency and throughput of jobs replayed by OfflineTest.
+
+    Jobs arrive stamped with the time they were pushed, the stamp
+    follows the job through its server's queue and is turned into a
+    latency sample when the server acknowledges it.
+    """
+    def __init__(self):
+        self.stamps    = {}     # msg -> time pushed, for jobs not yet sent
+        self.latencies = []
+        self.count     = 0      # jobs stamped
+        self.first     = None
+        self.last      = None
+        self.requested = False  # OfflineTest has pushed its last job
+
+    def stamp(self, msg, stamp):
+        if msg not in self.stamps:
+            self.count += 1
+        self.stamps[msg] = stamp
+        if self.first is None:
+            self.first = stamp
+
+    def take(self, msgs):
+        return [self.stamps.pop(msg, None) for msg in msgs]
+
+    def restore(self, msgs, stamps):
+        """Put the stamps of jobs moved to the spool back."""
+        for msg, stamp in zip(msgs, stamps):
+            if stamp is not None:
+                self.stamps[msg] = stamp
+
+    def ack(self, stamps):
+        self.last = time.time()
+        for stamp in stamps:
+            if stamp is not None:
+                self.latencies.append(self.last - stamp)
+
+    def done(self):
+        return self.requested and len(self.latencies) >= self.count
+
+    def percentile(self, values, p):
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    def report(self):
+        if len(self.latencies) == 0:
+            log.info('replay: no jobs were acknowledged')
+            return
+
+        latencies = sorted(self.latencies)
+        elapsed   = max(self.last - self.first, 0.000001)
+
+        log.info('replay: %d jobs in %0.2fs, %0.1f jobs/sec' % (len(latencies), elapsed, len(latencies) / elapsed))
+        log.info('replay: dispatch latency p50 %0.1fms p99 %0.1fms max %0.1fms' %
+                 (self.percentile(latencies, 0.50) * 1000, self.percentile(latencies, 0.99) * 1000, latencies[-1] * 1000))
+
+
+class PulseArchive(object):
+    """Append complete Pulse messages, one json document per line,
+    to a pulse_archive_YYYYMMDD.dat file that rolls over each UTC day.
+    """
+    def __init__(self, archivePath):
+        self.archivePath = archivePath
+        self.day         = None
+        self.handle      = None
+
+    def write(self, data):
+        day = datetime.utcnow().strftime('%Y%m%d')
+
+        if day != self.day:
+            if self.handle is not None:
+                self.handle.close()
+
+            s = os.path.join(self.archivePath, 'pulse_archive_%s.dat' % day)
+            log.info('archiving Pulse messages to %s' % s)
+
+            self.handle = open(s, 'a+')
+            self.day    = day
+
+        self.handle.write('%s\n' % json.dumps(data))
+
+def pulseProperties(section):
+    return [p for p in section.get('properties', []) if p[0] in PULSE_PROPERTIES]
+
+def projectBuild(payload):
+    result = {}
+    if 'build' in payload:
+        result['build'] = { 'properties': pulseProperties(payload['build']),
+                            'results':    payload['build'].get('results'),
+                          }
+    return result
+
+def projectChange(payload):
+    result = {}
+    if 'change' in payload:
+        change = payload['change']
+        result['change'] = { 'properties': pulseProperties(change),
+                             'revision':   change.get('revision'),
+                             'comments':   change.get('comments'),
+                             'project':    change.get('project'),
+                             'branch':     change.get('branch'),
+                           }
+    return result
+
+def projectSlave(payload):
+    return {}
+
+# routing key prefix -> only the parts of the payload bpServer reads
+pulseProjections = { 'build':  projectBuild,
+                     'change': projectChange,
+                     'slave':  projectSlave,
+                   }
+
+def projectPulse(msgType, data):
+    """ projectPulse
+    Slim a Pulse message down to what the job servers need, keeping the
+    same payload layout.  Message types without a projection are passed
+    through untouched.
+    """
+    if msgType in pulseProjections:
+        return { 'payload': pulseProjections[msgType](data['payload']) }
+    else:
+        return data
 
 def cbMessage(data, message):
     """ cbMessage
     Parses the incoming pulse event and create a "job" that will be sent
     to a job processing server via ZeroMQ router.
     
-    The job is placed into an event queue for async processing.
+    Only the fields the job servers use are kept from the Pulse message,
+    see projectPulse(), the complete message can be kept on disk with
+    the --pulsearchive option.
+
+    Messages Pulse redelivers within the --dedupe window are dropped.
+
+    The job is pushed to the ZeroMQ handler process for async processing.
     """
     message.ack()
 
+    if pulseArchive is not None:
+        pulseArchive.write(data)
+
+    if dedupe is not None:
+        duplicate = dedupe.seen(data['_meta']['message_id'])
+        stats     = dedupe.stats()
+
+        if (stats['hits'] + stats['bloomHits'] + stats['misses']) % DEDUPE_REPORT == 0:
+            log.info('dedupe: %(misses)d new, %(hits)d duplicates, %(bloomHits)d probable duplicates' % stats)
+
+        if duplicate:
+            log.debug('dropping duplicate Pulse message %s' % data['_meta']['message_id'])
+            return
+
     routingKey = data['_meta']['routing_key']
     msgType    = routingKey.split('.')[0]
     payload    = data['payload']
@@ -95,7 +329,7 @@ def cbMessage(data, message):
     job['pulse_key'] = routingKey
     job['time']      = data['_meta']['sent']
     job['id']        = data['_meta']['message_id']
-    job['pulse']     = data
+    job['pulse']     = projectPulse(msgType, data)
 
     if msgType == 'build':
         if 'build' in payload:
@@ -120,16 +354,29 @@ def cbMessage(data, message):
 
 
 class zmqService(object):
-    def __init__(self, serverID, router, db, events):
+    def __init__(self, serverID, router, db, wheel, spool, window=MSG_WINDOW):
         self.router   = router
         self.db       = db
-        self.events   = events
-        self.payload  = None
-        self.expires  = None
+        self.wheel    = wheel
+        self.spool    = spool
+        self.window   = window
+        self.pending  = {}    # sequence -> [payload, expiry timer, retries, time sent]
+        self.inflight = 0     # jobs sent but not yet acknowledged
+        self.latency  = None  # moving average of reply latency, in seconds
+        self.format   = WIRE_JSON
+        self.keyed    = False # send routing keys along, the server answered WIRE_KEYS
+        self.stamps   = {}    # sequence -> replay stamps of the jobs sent with it
         self.sequence = 0
         self.errors   = 0
         self.alive    = True
         self.lastPing = time.time()
+        self.busyTill = 0     # when a server that replied busy is tried again
+        self.refused  = 0     # jobs handed back by busy replies
+        self.queue    = []    # jobs routed here but not yet sent
+        self.deadline = None  # when the oldest queued job has to go out
+        self.batches  = 0     # batch counters, reset by stats()
+        self.jobs     = 0
+        self.maxBatch = 0
 
         self.id      = serverID
         self.address = self.id.replace('%s:' % ID_PULSE_WORKER, '')
@@ -142,8 +389,97 @@ class zmqService(object):
         self.router.connect(self.address)
         time.sleep(0.1)
 
+        # nothing is sent until the first pong settles the wire format
+        self.ping()
+
+        self.pingTimer = self.wheel.schedule(PING_INTERVAL, self.heartbeat)
+
     def isAvailable(self):
-        return self.alive and self.payload is None
+        return self.alive and not self.isBusy() and len(self.pending) < self.window
+
+    def isBusy(self):
+        return time.time() < self.busyTill
+
+    def credit(self):
+        """ credit
+        How many more requests can be sent before the window is full.
+        """
+        if self.alive and not self.isBusy():
+            return max(0, self.window - len(self.pending))
+        else:
+            return 0
+
+    def spare(self, batchSize, reserve=0):
+        """ spare
+        How many more jobs can be queued and still leave reserve
+        requests of credit once the queue is sent in batches of
+        batchSize.
+        """
+        return (self.credit() - reserve) * batchSize - len(self.queue)
+
+    def load(self):
+        """ load
+        Estimated seconds before a new job would be acknowledged:
+        everything in-flight or queued, plus the new job, times the
+        average reply latency.
+        """
+        if self.latency is None:
+            latency = LATENCY_DEFAULT
+        else:
+            latency = self.latency
+
+        return (self.inflight + len(self.queue) + 1) * latency
+
+    def close(self):
+        """ close
+        Stop all timers and hand any unacknowledged jobs to the spool
+        so they are replayed to the remaining servers.
+        """
+        self.wheel.cancel(self.pingTimer)
+        for sequence in self.pending:
+            self.wheel.cancel(self.pending[sequence][1])
+            self.respool(self.pending[sequence][0], self.stamps.pop(sequence, None))
+        self.pending  = {}
+        self.inflight = 0
+
+        if len(self.queue) > 0:
+            for key, msg in self.queue:
+                self.spool.append(msg)
+            log.warning('%d jobs queued for %s moved to the spool' % (len(self.queue), self.id))
+        self.queue = []
+
+    def respool(self, payload, stamps=None):
+        msgs = requestJobs(payload)
+        if len(msgs) > 0:
+            for msg in msgs:
+                self.spool.append(msg)
+            if stamps is not None and replayStats is not None:
+                replayStats.restore(msgs, stamps)
+            log.warning('%d jobs sent to %s moved to the spool' % (len(msgs), self.id))
+
+    def shed(self, payload, stamps=None):
+        """ shed
+        The server replied busy: it did not take the jobs of payload.
+        They, and everything queued for the server, go to the spool to
+        be replayed to whichever servers have credit, and the server
+        is sent nothing for BUSY_BACKOFF seconds.
+        """
+        if not self.isBusy():
+            log.warning('server %s is busy, diverting its jobs' % self.id)
+
+        self.busyTill = time.time() + BUSY_BACKOFF
+
+        msgs = requestJobs(payload)
+        if len(msgs) > 0:
+            self.refused += len(msgs)
+            for msg in msgs:
+                self.spool.append(msg)
+            if stamps is not None and replayStats is not None:
+                replayStats.restore(msgs, stamps)
+
+        for key, msg in self.queue:
+            self.spool.append(msg)
+        self.queue = []
 
     def reply(self, reply):
         if options.debug:
@@ -157,162 +493,551 @@ class zmqService(object):
         self.errors   = 0
         self.alive    = True
         self.lastPing = time.time()
-        self.expires  = self.lastPing + MSG_TIMEOUT
 
-        if int(sequenceReply) == self.sequence:
-            self.payload = None
+        if reply[0] == 'pong' and len(reply) > 1 and reply[1] != self.format:
+            if reply[1] in formats():
+                log.info('server %s will be sent %s' % (self.id, reply[1]))
+                self.format = reply[1]
+            else:
+                log.error('server %s picked unknown wire format %s' % (self.id, reply[1]))
+
+        if reply[0] == 'pong':
+            self.keyed = WIRE_KEYS in reply[2:]
+
+        if sequenceReply in self.pending:
+            payload, timer, retries, sent = self.pending[sequenceReply]
+
+            self.wheel.cancel(timer)
+            del self.pending[sequenceReply]
+            self.inflight -= len(requestJobs(payload))
+
+            stamps = self.stamps.pop(sequenceReply, None)
+            if reply[0] == 'busy':
+                self.shed(payload, stamps)
+            elif stamps is not None and replayStats is not None:
+                replayStats.ack(stamps)
+
+            # replies to retransmitted requests are ambiguous, skip them
+            if retries == 0:
+                sample = self.lastPing - sent
+                if self.latency is None:
+                    self.latency = sample
+                else:
+                    self.latency = (LATENCY_ALPHA * sample) + ((1 - LATENCY_ALPHA) * self.latency)
         else:
-            log.error('reply received out of sequence')
+            # most likely a late reply to a request that was retransmitted
+            log.warning('reply received for unknown sequence %s from %s' % (sequenceReply, self.id))
+
+    def enqueue(self, key, msg, batchTime):
+        if len(self.queue) == 0:
+            self.deadline = time.time() + batchTime
+        self.queue.append((key, msg))
+
+    def flush(self, batchSize):
+        """ flush
+        Send queued jobs while there is credit, full batches right away
+        and a partial batch only once its deadline has passed.
+        """
+        while len(self.queue) > 0 and self.isAvailable():
+            if len(self.queue) < batchSize and time.time() < self.deadline:
+                break
+
+            self.request(self.queue[:batchSize])
+            del self.queue[:batchSize]
+
+    def request(self, queued):
+        """ request
+        Send a batch of queued (routing key, job) pairs as a single
+        message.
 
-    def request(self, msg):
+        A server that answered WIRE_KEYS is sent a 'keyed' control, a
+        frame with the routing keys one per line and a frame per job.
+        Otherwise a single job goes out as a 'job' control, anything
+        more as 'jobs' with one frame per job after the control frame.
+        """
         if options.debug:
             log.debug('request %s' % self.id)
 
         if self.isAvailable():
             self.sequence += 1
-            self.payload   = [self.id, str(self.sequence), 'job', msg]
-            self.expires   = time.time() + MSG_TIMEOUT
+            sequence = str(self.sequence)
+            keys     = [key for key, msg in queued]
+            msgs     = [msg for key, msg in queued]
+
+            if replayStats is not None:
+                self.stamps[sequence] = replayStats.take(msgs)
+
+            if self.format != preferred():
+                msgs = [transcodeJob(msg, self.format) for msg in msgs]
+
+            if self.keyed:
+                payload = [self.id, sequence, 'keyed', '\n'.join(keys)] + msgs
+            elif len(msgs) == 1:
+                payload = [self.id, sequence, 'job'] + msgs
+            else:
+                payload = [self.id, sequence, 'jobs'] + msgs
+
+            self.pending[sequence] = [payload, self.wheel.schedule(MSG_TIMEOUT, self.expire, sequence), 0, time.time()]
+
+            self.inflight += len(msgs)
+            self.batches  += 1
+            self.jobs     += len(msgs)
+            if len(msgs) > self.maxBatch:
+                self.maxBatch = len(msgs)
 
             if options.debug:
-                log.debug('send %s %d chars [%s]' % (self.id, len(msg), msg[:42]))
+                log.debug('send %s %d jobs [%r]' % (self.id, len(msgs), msgs[0][:42]))
 
-            self.router.send_multipart(self.payload)
+            self.router.send_multipart(payload)
 
             return True
         else:
             return False
 
-    def heartbeat(self):
-        if self.payload is not None and time.time() > self.expires:
-            if self.payload[2] == 'ping':
-                log.warning('server %s has failed to respond to %d ping requests' % (self.id, self.errors))
-                if self.errors >= PING_FAIL_MAX:
-                    log.error('removing %s from server list' % self.id)
-                    db.sadd('%s:inactive' % ID_PULSE_WORKER, self.id)
-                else:
-                    self.ping(force=True)
+    def expire(self, sequence):
+        """ expire
+        Called by the timer wheel when a request has gone MSG_TIMEOUT
+        seconds without a reply.
+        """
+        if sequence not in self.pending:
+            return
+
+        entry = self.pending[sequence]
+        payload, timer, retries, sent = entry
+
+        if payload[2] == 'ping':
+            del self.pending[sequence]
+
+            log.warning('server %s has failed to respond to %d ping requests' % (self.id, self.errors))
+            if self.errors >= PING_FAIL_MAX:
+                log.error('removing %s from server list' % self.id)
+                self.db.sadd('%s:inactive' % ID_PULSE_WORKER, self.id)
             else:
-                log.warning('server %s has expired request: %s' % (self.id, ','.join(self.payload)))
+                self.ping(force=True)
+
+        elif retries < MSG_RETRIES:
+            log.warning('server %s has expired request %s, retransmitting' % (self.id, sequence))
+
+            entry[1]  = self.wheel.schedule(MSG_TIMEOUT, self.expire, sequence)
+            entry[2] += 1
+
+            self.router.send_multipart(payload)
+        else:
+            log.error('server %s did not acknowledge request %s after %d retries, spooling it' % (self.id, sequence, retries))
+            del self.pending[sequence]
+            self.inflight -= len(requestJobs(payload))
+
+            self.respool(payload, self.stamps.pop(sequence, None))
+
+            self.ping(force=True)
+
+    def heartbeat(self):
+        """ heartbeat
+        Ping the server once it has been idle for PING_INTERVAL seconds.
+        Any reply counts as activity so the timer is simply pushed out
+        until the server really has gone quiet.
+        """
+        idle = time.time() - self.lastPing
+
+        if idle >= PING_INTERVAL:
+            if len(self.pending) == 0:
                 self.ping()
+            idle = 0
+
+        self.pingTimer = self.wheel.schedule(PING_INTERVAL - idle, self.heartbeat)
 
-        if time.time() - self.lastPing > PING_INTERVAL:
-            self.ping()
+    def stats(self):
+        if self.batches > 0:
+            log.info('server %s: %d jobs in %d batches, avg %0.1f max %d per batch, latency %0.3fs, %d refused' %
+                     (self.id, self.jobs, self.batches, float(self.jobs) / self.batches, self.maxBatch, self.latency or 0,
+                      self.refused))
+
+        self.batches  = 0
+        self.jobs     = 0
+        self.maxBatch = 0
+        self.refused  = 0
 
     def ping(self, force=False):
         if options.debug:
             log.debug('ping %s' % self.id)
 
-        if force or self.isAvailable():
+        if force or (self.alive and len(self.pending) < self.window):
             self.sequence += 1
-            self.payload   = [self.id, str(self.sequence), 'ping']
+            sequence = str(self.sequence)
+            payload  = [self.id, sequence, 'ping', ' '.join(formats() + [WIRE_KEYS])]
+
             self.lastPing  = time.time()
-            self.expires   = self.lastPing + MSG_TIMEOUT
             self.errors   += 1
             self.alive     = False
 
-            self.router.send_multipart(self.payload)
+            self.pending[sequence] = [payload, self.wheel.schedule(MSG_TIMEOUT, self.expire, sequence), 0, self.lastPing]
+
+            self.router.send_multipart(payload)
         else:
             log.warning('ping requested for offline service [%s]' % self.id)
 
-def discoverServers(servers, db, events, router):
-    for serverID in db.lrange(ID_PULSE_WORKER, 0, -1):
+def requestJobs(payload):
+    """ requestJobs
+    The job frames of a request sent to a server, none for a ping.
+    """
+    if payload[2] in ('job', 'jobs'):
+        return payload[3:]
+    elif payload[2] == 'keyed':
+        return payload[4:]
+    else:
+        return []
+
+class DispatchPolicy(object):
+    """Base dispatch policy.
+
+    Decides which servers a job may be queued on, in order of
+    preference.  route() takes the first one that is alive and
+    still has room in its queue.  Servers are offered in sorted
+    order, policies override candidates() to prefer others.
+
+    A sticky policy only moves a job past a server that is down or
+    busy, one that is merely backed up is waited for.
+    """
+    sticky = False
+
+    def add(self, serverID):
+        pass
+
+    def remove(self, serverID):
+        pass
+
+    def candidates(self, servers, key):
+        return sorted(servers.keys())
+
+class FirstAvailablePolicy(DispatchPolicy):
+    """Always prefer whichever server sorts first."""
+    pass
+
+class HashRingPolicy(DispatchPolicy):
+    """Prefer the server that owns the job's key on a consistent
+    hash ring so every event for a build lands on the same server.
+    """
+    sticky = True
+
+    def __init__(self):
+        self.ring = HashRing()
+
+    def add(self, serverID):
+        self.ring.add(serverID)
+
+    def remove(self, serverID):
+        self.ring.remove(serverID)
+
+    def candidates(self, servers, key):
+        return self.ring.nodes(key)
+
+class LeastLoadedPolicy(DispatchPolicy):
+    """Prefer the server with the lowest zmqService.load() - the
+    jobs it has in-flight and queued weighted by its reply latency.
+    """
+    def candidates(self, servers, key):
+        return sorted(servers.keys(), key=lambda serverID: servers[serverID].load())
+
+dispatchPolicies = { 'first':     FirstAvailablePolicy,
+                     'hash':      HashRingPolicy,
+                     'leastload': LeastLoadedPolicy,
+                   }
+
+def dropServer(servers, policy, serverID):
+    policy.remove(serverID)
+    servers[serverID].close()
+    del servers[serverID]
+
+def discoverServers(servers, policy, db, wheel, spool, router, window=MSG_WINDOW):
+    listed = db.lrange(ID_PULSE_WORKER, 0, -1)
+
+    for serverID in listed:
         if db.sismember('%s:inactive' % ID_PULSE_WORKER, serverID):
             log.warning('server %s found in inactive list, disconnecting' % serverID)
             if serverID in servers:
-                servers[serverID] = None
-                del servers[serverID]
+                dropServer(servers, policy, serverID)
         else:
             if serverID not in servers:
                 log.debug('server %s is new, adding to connect queue' % serverID)
-                servers[serverID] = zmqService(serverID, router, db, events)
+                servers[serverID] = zmqService(serverID, router, db, wheel, spool, window)
+                policy.add(serverID)
+
+    # a draining server takes itself off the list, its jobs go to the
+    # rest instead of waiting for it to stop answering pings
+    for serverID in servers.keys():
+        if serverID not in listed:
+            log.warning('server %s is no longer listed, disconnecting' % serverID)
+            dropServer(servers, policy, serverID)
+
+def checkServers(servers, policy, db, wheel, spool, router, window):
+    for serverID in servers:
+        servers[serverID].stats()
+
+    discoverServers(servers, policy, db, wheel, spool, router, window)
 
-def handleZMQ(options, events, db):
+    wheel.schedule(SERVER_CHECK_INTERVAL, checkServers, servers, policy, db, wheel, spool, router, window)
+
+def syncSpool(wheel, spool):
+    spool.sync()
+    wheel.schedule(SPOOL_SYNC, syncSpool, wheel, spool)
+
+def route(servers, policy, spool, key, msg, batchTime, depth, reserve=0, batchSize=1):
+    """ route
+    Queue a job on the first server the dispatch policy offers that
+    is alive, not busy and has fewer than depth jobs queued.  If there
+    are no servers, or every one of them is busy, the job is spooled.
+
+    With a reserve the server also has to have reserve requests of
+    credit left once its queue, job included, has gone out in batches
+    of batchSize.
+
+    A sticky policy's job only moves on to the next server when the
+    one before it is down or busy, it is never split off from the
+    rest of its build because a server's queue is full.
+
+    Returns False only when servers are known but none can take the
+    job, the caller is expected to hold onto it until credit returns.
+    """
+    if len(servers) == 0:
+        if len(spool) == 0:
+            log.error('no active servers to handle request, spooling jobs')
+        spool.append(msg)
+        return True
+
+    busy = 0
+    for serverID in policy.candidates(servers, key):
+        server = servers[serverID]
+        if server.isBusy():
+            busy += 1
+        elif server.alive:
+            if len(server.queue) < depth and (reserve == 0 or server.spare(batchSize, reserve) > 0):
+                server.enqueue(key, msg, batchTime)
+                return True
+            if policy.sticky:
+                return False
+
+    if busy == len(servers):
+        spool.append(msg)
+        return True
+
+    return False
+
+def handleZMQ(options, db):
     """ handleZMQ
     Primary event loop for everything ZeroMQ related
     
-    All payloads to be sent onward arrive via the event queue.
+    All payloads to be sent onward arrive on a PULL socket bound to
+    options.events, pushJob() is the other end of it.  Both that socket
+    and the server ROUTER socket are in the same poller so the loop
+    only wakes up when there is a job, a reply or a timer due.
     
     Currently it is a very simple implementation of the Freelance
-    pattern with no server heartbeat checks.
+    pattern with a per-server credit window: each server can have
+    up to options.window requests in-flight, each one tracked by
+    sequence number and retransmitted if it expires.  Expiry, pings
+    and server discovery all run off a timer wheel.
+
+    Each job carries a routing key - its builduid, or the slave name if
+    it has none - and options.policy decides which server it is queued
+    for:
+
+        hash        the server that owns the key on a consistent hash
+                    ring, so every event for a build lands on the same
+                    server and only a departing server's keys move
+        leastload   the server with the least in-flight and queued work
+                    weighted by its average reply latency
+        first       whichever server sorts first
+
+    Jobs are coalesced into per-server batches of up to options.batchsize
+    jobs, a partial batch is sent once it is options.batchtime ms old.
+    When no server can queue any more the PULL socket is taken out of
+    the poller so jobs back up into pushJob() instead.
+
+    A server that is falling behind replies 'busy' instead of 'ok' and
+    is left alone for BUSY_BACKOFF seconds, the jobs it refused and
+    those queued for it are spooled and so go to the other servers.
+
+    Jobs that cannot be delivered - no servers, every server busy, or
+    a server that never acknowledged them - are written to an on-disk
+    spool under options.spoolpath.  Spooled jobs are replayed with whatever credit
+    is left after live jobs have been sent, always keeping a slot per
+    server free so live traffic is never starved by the replay.
     
-    The incoming events are structured as a list that always
-    begins with the event type.
+    The incoming events are multipart messages that always
+    begin with the event type.
     
-        Job:            ('job',  "{'payload': 'sample'}")
-        Heartbeat:      ('ping',)
+        Job:            ['job',  routing key, "{'payload': 'sample'}"]
+        Replayed job:   ['job',  routing key, "{'payload': 'sample'}", time pushed]
+        Replay done:    ['report']
     
     The structure of the message sent between nodes is:
     
         [destination, sequence, control, payload]
+        [destination, sequence, 'jobs', payload, payload, ...]
+        [destination, sequence, 'keyed', routing keys, payload, ...]
+        [destination, sequence, 'ping', formats]
     
-    all items are sent as strings.
+    all items are sent as strings.  Jobs are encoded in the wire format
+    each server picked in its reply to the first ping, see releng.wire.
     """
+    global replayStats
+
     log.info('starting')
 
-    servers       = {}
-    lastDiscovery = time.time()
+    servers = {}
+    policy  = None
+    held    = None    # a job no server could take yet
+    wheel   = TimerWheel(tick=TIMER_TICK)
+    spool   = Spool(options.spoolpath, 'pulsebroker')
+
+    try:
+        window = int(options.window)
+    except:
+        log.error('invalid window value [%s] - using default of %d' % (options.window, MSG_WINDOW))
+        window = MSG_WINDOW
+
+    try:
+        batchSize = max(1, int(options.batchsize))
+    except:
+        log.error('invalid batchsize value [%s] - using default of %d' % (options.batchsize, BATCH_SIZE))
+        batchSize = BATCH_SIZE
+
+    try:
+        batchTime = float(options.batchtime) / 1000
+    except:
+        log.error('invalid batchtime value [%s] - using default of %d' % (options.batchtime, BATCH_TIME))
+        batchTime = BATCH_TIME / 1000.0
 
     context = zmq.Context()
     router  = context.socket(zmq.ROUTER)
+    events  = context.socket(zmq.PULL)
     poller  = zmq.Poller()
+
+    log.debug('receiving jobs on %s' % options.events)
+    events.bind(options.events)
+
     poller.register(router, zmq.POLLIN)
+    poller.register(events, zmq.POLLIN)
+    listening = True
+
+    if options.policy in dispatchPolicies:
+        policy = dispatchPolicies[options.policy]()
+    else:
+        log.error('unknown dispatch policy [%s] - using hash' % options.policy)
+        policy = HashRingPolicy()
+
+    depth = batchSize * QUEUE_DEPTH
+
+    checkServers(servers, policy, db, wheel, spool, router, window)
+    syncSpool(wheel, spool)
 
     while True:
-        available = False
-        for serverID in servers:
-            if servers[serverID].isAvailable():
-                available = True
-                break
+        # keep pulling events until no server can queue any more,
+        # whatever is left stays queued in the PUSH/PULL pipe
+        while True:
+            if held is None:
+                try:
+                    event = events.recv_multipart(zmq.NOBLOCK)
+                except zmq.ZMQError:
+                    break
+            else:
+                event = held
+                held  = None
 
-        try:
-            event = events.get(False)
-        except Empty:
-            event = None
-
-        if event is not None:
-            if available:
-                eventType = event[0]
-
-                if eventType == 'ping':
-                    ping(servers, event[1])
-
-                elif eventType == 'job':
-                    handled = False
-                    for serverID in servers:
-                        if servers[serverID].isAvailable() and servers[serverID].request(event[1]):
-                            handled = True
-                            break
-                    if not handled:
-                        log.error('no active servers to handle request')
-                        # TODO - push archived item to redis
+            eventType = event[0]
+
+            if eventType == 'job':
+                if not route(servers, policy, spool, event[1], event[2], batchTime, depth):
+                    held = event
+                    break
 
+                if len(event) > 3:
+                    if replayStats is None:
+                        replayStats = ReplayStats()
+                    replayStats.stamp(event[2], float(event[3]))
+
+            elif eventType == 'report':
+                if replayStats is None:
+                    log.info('replay: no jobs were replayed')
                 else:
-                    log.warning('unknown event [%s]' % eventType)
+                    replayStats.requested = True
+
             else:
-                log.error('no active servers to handle request')
+                log.warning('unknown event [%s]' % eventType)
+
+        for serverID in servers:
+            servers[serverID].flush(batchSize)
+
+        # replay spooled jobs with the credit live jobs did not need,
+        # only onto servers that keep a slot free after the job.  The
+        # first job that cannot go anywhere ends the pass and stays at
+        # the head of the spool so jobs of a build are replayed in order
+        if held is None and len([s for s in servers if not servers[s].isBusy()]) > 0:
+            replaying = True
+            while replaying and len(spool) > 0:
+                msgs = spool.read(batchSize)
+                for i in range(0, len(msgs)):
+                    if not route(servers, policy, spool, routeKey(decodeJob(msgs[i])), msgs[i], 0, depth, 1, batchSize):
+                        spool.rewind(i)
+                        replaying = False
+                        break
+                spool.commit()
+
+                for serverID in servers:
+                    servers[serverID].flush(batchSize)
+
+        if listening != (held is None):
+            listening = not listening
+            if listening:
+                poller.register(events, zmq.POLLIN)
+            else:
+                poller.unregister(events)
+
+        # a batch past its deadline is waiting on credit, not the clock
+        timeout = wheel.timeout()
+        for serverID in servers:
+            server = servers[serverID]
+            if len(server.queue) > 0 and server.deadline > time.time():
+                if timeout is None:
+                    timeout = server.deadline - time.time()
+                else:
+                    timeout = min(timeout, server.deadline - time.time())
+
+        if timeout is not None:
+            timeout = max(0, timeout * 1000)
 
         try:
-            items = dict(poller.poll(100))
+            items = dict(poller.poll(timeout))
         except:
             break
 
-        if router in items:
+        while router in items:
             reply    = router.recv_multipart()
             serverID = reply.pop(0)
-            servers[serverID].reply(reply)
-        else:
-            for serverID in servers:
-                servers[serverID].heartbeat()
+            if serverID in servers:
+                servers[serverID].reply(reply)
+            else:
+                log.warning('reply received from unknown server %s' % serverID)
+
+            items = dict(poller.poll(0))
+
+        wheel.advance()
 
-        if time.time() > lastDiscovery:
-            discoverServers(servers, db, events, router)
-            lastDiscovery = time.time() + SERVER_CHECK_INTERVAL
+        if replayStats is not None and replayStats.done():
+            replayStats.report()
+            replayStats = None
 
     log.info('done')
 
-def pushJob(job):
-    s = json.dumps(job)
-    eventQueue.put(('job', s))
+def pushJob(job, key=None, stamp=None):
+    if key is None:
+        key = routeKey(job)
+
+    s = encodeJob(job, preferred())
+    if stamp is None:
+        eventSocket.send_multipart(['job', key, s])
+    else:
+        eventSocket.send_multipart(['job', key, s, repr(stamp)])
 
 
 _defaultOptions = { 'config':      ('-c', '--config',     None,             'Configuration file'),
@@ -324,7 +1049,16 @@ _defaultOptions = { 'config':      ('-c', '--config',     None,             'Con
                     'redisdb':     ('',   '--redisdb',    '8',              'Redis database'),
                     'pulse':       ('-p', '--pulse',      None,             'Pulse connection string'),
                     'topic':       ('-t', '--topic',      '#',              'Mozilla Pulse Topic filter string'),
-                    'testfile':    ('',   '--testfile',   None,             'Offline testing, uses named file instead of Pulse server'),
+                    'testfile':    ('',   '--testfile',   None,             'Offline testing, replays the named archive files instead of listening to Pulse'),
+                    'speed':       ('',   '--speed',      0,                'Replay speed: 1 original timing, N times as fast, 0 flat out'),
+                    'window':      ('-w', '--window',     MSG_WINDOW,       'How many jobs each server can have in-flight'),
+                    'batchsize':   ('',   '--batchsize',  BATCH_SIZE,       'Most jobs sent to a server in one message'),
+                    'batchtime':   ('',   '--batchtime',  BATCH_TIME,       'Milliseconds a partial batch waits for more jobs'),
+                    'events':      ('',   '--events',     None,             'ZeroMQ address jobs are handed to the dispatcher on'),
+                    'spoolpath':   ('',   '--spoolpath',  '.',              'Path where undeliverable jobs are spooled'),
+                    'policy':      ('',   '--policy',     'hash',           'How jobs are spread across servers: hash, leastload or first'),
+                    'pulsearchive':('',   '--pulsearchive', None,           'Path where complete Pulse messages are archived'),
+                    'dedupe':      ('',   '--dedupe',     DEDUPE_WINDOW,    'Seconds a Pulse message id is remembered, 0 to disable'),
                   }
 
 
@@ -334,11 +1068,36 @@ if __name__ == '__main__':
 
     log.info('Starting')
 
+    # each broker gets its own socket, a second broker on the host
+    # must not end up pushing its jobs to this one
+    if options.events is None:
+        options.events = 'ipc://%s' % os.path.join(os.path.abspath(options.spoolpath), 'pulsebroker.%d.ipc' % os.getpid())
+
+    if options.events.startswith('ipc://') and os.path.exists(options.events[6:]):
+        log.error('%s is already in use by another broker, or left behind by one, exiting' % options.events)
+        sys.exit(2)
+
     log.info('Connecting to datastore')
     db = dbRedis(options)
 
     log.info('Creating ZeroMQ handler')
-    Process(name='zmq', target=handleZMQ, args=(options, eventQueue, db)).start()
+    Process(name='zmq', target=handleZMQ, args=(options, db)).start()
+
+    context     = zmq.Context()
+    eventSocket = context.socket(zmq.PUSH)
+    eventSocket.connect(options.events)
+
+    if options.pulsearchive is not None:
+        pulseArchive = PulseArchive(options.pulsearchive)
+
+    try:
+        dedupeWindow = max(0, int(options.dedupe))
+    except:
+        log.error('invalid dedupe value [%s] - using default of %d' % (options.dedupe, DEDUPE_WINDOW))
+        dedupeWindow = DEDUPE_WINDOW
+
+    if dedupeWindow > 0:
+        dedupe = Dedupe(window=dedupeWindow)
 
     if options.testfile:
         OfflineTest(options)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" bpArchive
+
+    query bpServer's job archives
+
+    :copyright: (c) 2012 by Mozilla
+    :license: MPLv2
+
+    Assumes Python v2.6+
+
+    Usage
+        bpArchive.py [options] archive [archive ...]
+
+        -c --config         Configuration file (json format)
+                            default: None
+           --start          Only jobs received at or after this time, UTC,
+                            as an epoch, YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS
+                            default: None
+           --end            Only jobs received at or before this time
+                            default: None
+           --slave          Only jobs for this slave
+                            default: None
+           --builduid       Only jobs for this builduid
+                            default: None
+           --blocks         List the matching blocks from the index instead
+                            of the jobs
+                            default: False
+
+    Matching jobs are written to stdout one json document per line,
+    the same as a plain archive, so the output can be handed to
+    PulseBroker's --testfile.
+
+    Sample Configuration file
+
+        { 'slave': 'talos-r3-fed-001'
+        }
+
+    Authors:
+        bear    Mike Taylor <bear@mozilla.com>
+"""
+
+import sys
+import time
+import calendar
+
+from releng import initOptions
+from releng.archive import ArchiveReader
+
+
+def parseTime(value):
+    """ parseTime
+    Epoch for an epoch, YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS value, the
+    latter two taken as UTC.  None is passed through.
+    """
+    if value is None:
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(value, fmt))
+        except ValueError:
+            pass
+
+    raise ValueError('unable to parse time [%s]' % value)
+
+
+_defaultOptions = { 'config':   ('-c', '--config',   None,  'Configuration file'),
+                    'start':    ('',   '--start',    None,  'Only jobs received at or after this time'),
+                    'end':      ('',   '--end',      None,  'Only jobs received at or before this time'),
+                    'slave':    ('',   '--slave',    None,  'Only jobs for this slave'),
+                    'builduid': ('',   '--builduid', None,  'Only jobs for this builduid'),
+                    'blocks':   ('',   '--blocks',   False, 'List the matching blocks instead of the jobs', 'b'),
+                  }
+
+if __name__ == '__main__':
+    options = initOptions(params=_defaultOptions)
+
+    if len(options.args) == 0:
+        print 'at least one archive is needed'
+        sys.exit(2)
+
+    try:
+        start = parseTime(options.start)
+        end   = parseTime(options.end)
+    except ValueError, e:
+        print e
+        sys.exit(2)
+
+    for filename in options.args:
+        reader = ArchiveReader(filename)
+
+        if options.blocks:
+            if reader.plain:
+                print '%s is a plain archive and has no index' % filename
+                continue
+
+            blocks = reader.blocks(start, end, options.slave, options.builduid)
+            print '%s: %d of %d blocks, %d jobs' % (reader.filename, len(blocks), len(reader.index), len(reader))
+            for block in blocks:
+                print '    %10d %8d bytes %6d jobs  %s - %s' % (block['offset'], block['length'], block['count'],
+                                                               time.strftime('%H:%M:%S', time.gmtime(block['first'])),
+                                                               time.strftime('%H:%M:%S', time.gmtime(block['last'])))
+        else:
+            for stamp, entry in reader.records(start, end, options.slave, options.builduid):
+                print entry
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" bpBench
+
+    micro benchmarks for the briarpatch plumbing
+
+    :copyright: (c) 2012 by Mozilla
+    :license: MPLv2
+
+    Assumes Python v2.6+
+
+    Usage
+        -c --config         Configuration file (json format)
+                            default: None
+           --bench          Which benchmark to run
+                                wire    encode/decode time and frame size for
+                                        each wire format, jobs are read from
+                                        a recorded bpServer or PulseBroker archive
+                                ring    jobs/sec handed from one process to
+                                        another through a multiprocessing Queue
+                                        and through a shared memory RingBuffer
+                                copies  jobs/sec from a zmq socket to a worker
+                                        process that decodes them, through a
+                                        multiprocessing Queue and through a
+                                        RingBuffer with copying receives and
+                                        with copy=False frames
+                                journal jobs/sec handed to a worker process
+                                        through a RingBuffer as bpServer does it,
+                                        without a journal, with one and with one
+                                        that is fsync'd for every batch
+                            default: wire
+           --archive        Archive file to read recorded jobs from
+                            Required Value for the wire benchmark, the ring
+                            and copies benchmarks use synthetic 500 byte jobs
+                            without it
+           --count          Maximum number of recorded jobs to use
+                            default: 10000
+           --rounds         How many times each benchmark is repeated,
+                            the best round is reported
+                            default: 3
+           --journalpath    Directory the journal benchmark writes to
+                            default: /tmp/bpbench
+
+    Sample Configuration file
+
+        { 'bench': 'wire',
+          'archive': '/var/log/briarpatch/bp_archive_20120314.blk'
+        }
+
+    Authors:
+        bear    Mike Taylor <bear@mozilla.com>
+"""
+
+import os, sys
+import json
+import time
+import shutil
+import struct
+
+import zmq
+
+from multiprocessing import Process, Queue
+
+from releng import initOptions
+from releng.ring import RingBuffer
+from releng.spool import Spool, SpoolCursor
+from releng.archive import readArchive
+from releng.wire import WIRE_JSON, formats, encodeJob, decodeJob, encodeMetrics, decodeMetrics
+from releng.constants import METRICS_COUNT
+
+
+def loadArchive(filename, count):
+    jobs = []
+    for job in readArchive(filename):
+        jobs.append(job)
+        if len(jobs) >= count:
+            break
+    return jobs
+
+def metricsFor(job):
+    """ metricsFor
+    Build a metrics batch shaped like the ones bpServer's worker
+    sends for job.
+    """
+    outbound = [(METRICS_COUNT, ('metrics', 'pulse'))]
+    slave    = job.get('slave')
+    event    = job.get('event')
+
+    if event is not None:
+        outbound.append((METRICS_COUNT, ('build', event)))
+    if slave is not None:
+        outbound.append((METRICS_COUNT, ('build:started:slave',  slave)))
+        outbound.append((METRICS_COUNT, ('build:started:master', job.get('master'))))
+
+    return outbound
+
+def timeit(rounds, func, items):
+    best = None
+    for i in range(0, rounds):
+        t = time.time()
+        result = [func(item) for item in items]
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+    return best, result
+
+def benchWire(options):
+    if options.archive is None:
+        print 'the wire benchmark needs --archive'
+        sys.exit(2)
+
+    rounds = int(options.rounds)
+    jobs   = loadArchive(options.archive, int(options.count))
+    if len(jobs) == 0:
+        print 'no jobs found in %s' % options.archive
+        sys.exit(1)
+
+    metrics = [metricsFor(job) for job in jobs]
+
+    print '%d jobs from %s, best of %d rounds' % (len(jobs), options.archive, rounds)
+    print
+    print '%-8s %-10s %12s %12s %12s %8s' % ('payload', 'format', 'encode us', 'decode us', 'avg bytes', 'ratio')
+
+    for name, items, encode, decode in (('jobs',    jobs,    encodeJob,     decodeJob),
+                                        ('metrics', metrics, encodeMetrics, decodeMetrics)):
+        baseline = None
+        for fmt in formats()[::-1]:
+            tEncode, frames = timeit(rounds, lambda item: encode(item, fmt), items)
+            tDecode, _      = timeit(rounds, decode, frames)
+
+            size = float(sum([len(frame) for frame in frames])) / len(frames)
+            if fmt == WIRE_JSON:
+                baseline = size
+
+            print '%-8s %-10s %12.2f %12.2f %12.1f %8.2f' % (name, fmt, tEncode * 1000000 / len(items),
+                                                             tDecode * 1000000 / len(items), size, size / baseline)
+
+    if len(formats()) == 1:
+        print
+        print 'msgpack is not installed, only json was measured'
+
+
+def benchMessages(options):
+    if options.archive is None:
+        msgs = [json.dumps({'event': 'x' * 480})] * int(options.count)
+    else:
+        msgs = [json.dumps(job) for job in loadArchive(options.archive, int(options.count))]
+        if len(msgs) == 0:
+            print 'no jobs found in %s' % options.archive
+            sys.exit(1)
+    return msgs
+
+def drain(queue, count):
+    for i in range(0, count):
+        queue.get()
+
+def benchRing(options):
+    rounds = int(options.rounds)
+
+    msgs   = benchMessages(options)
+    size   = float(sum([len(msg) for msg in msgs])) / len(msgs)
+
+    print '%d jobs, avg %0.1f bytes, best of %d rounds' % (len(msgs), size, rounds)
+    print
+    print '%-12s %12s %12s' % ('queue', 'jobs/sec', 'us/job')
+
+    for name, factory in (('Queue', Queue), ('RingBuffer', RingBuffer)):
+        best = None
+        for i in range(0, rounds):
+            queue    = factory()
+            consumer = Process(target=drain, args=(queue, len(msgs)))
+            consumer.start()
+
+            t = time.time()
+            for msg in msgs:
+                queue.put(msg)
+            consumer.join()
+            t = time.time() - t
+
+            if best is None or t < best:
+                best = t
+
+        print '%-12s %12.0f %12.2f' % (name, len(msgs) / best, best * 1000000 / len(msgs))
+
+
+def decodeAll(queue, count):
+    for i in range(0, count):
+        decodeJob(queue.get())
+
+def benchCopies(options):
+    """ benchCopies
+    Time each job from a zmq socket to a worker process that decodes
+    it, the way bpServer's receive loop and worker do: through a
+    multiprocessing Queue as bpServer did before the rings, and through
+    a RingBuffer with a copying receive and with copy=False frames.
+
+    Only time is reported, the copies themselves happen inside zmq,
+    pickle and the ring and are not counted.
+    """
+    rounds  = int(options.rounds)
+    msgs    = benchMessages(options)
+    size    = float(sum([len(msg) for msg in msgs])) / len(msgs)
+    context = zmq.Context()
+
+    print '%d jobs, avg %0.1f bytes, best of %d rounds' % (len(msgs), size, rounds)
+    print
+    print '%-12s %-12s %12s %12s %10s' % ('queue', 'receive', 'jobs/sec', 'us/job', 'vs Queue')
+
+    baseline = None
+    endpoint = 0
+    for name, factory, copy in (('Queue',      Queue,      True),
+                                ('RingBuffer', RingBuffer, True),
+                                ('RingBuffer', RingBuffer, False)):
+        best = None
+        for i in range(0, rounds):
+            queue    = factory()
+            sink     = context.socket(zmq.PULL)
+            source   = context.socket(zmq.PUSH)
+            consumer = Process(target=decodeAll, args=(queue, len(msgs)))
+            # a closed socket's endpoint is released in the background
+            endpoint += 1
+            sink.bind('inproc://bpbench%d' % endpoint)
+            source.connect('inproc://bpbench%d' % endpoint)
+            consumer.start()
+
+            t = time.time()
+            for msg in msgs:
+                source.send(msg)
+                queue.put(sink.recv_multipart(copy=copy)[0])
+            consumer.join()
+            t = time.time() - t
+
+            sink.close()
+            source.close()
+
+            if best is None or t < best:
+                best = t
+
+        if baseline is None:
+            baseline = best
+
+        print '%-12s %-12s %12.0f %12.2f %9.0f%%' % (name, 'copy=%s' % copy, len(msgs) / best,
+                                                   best * 1000000 / len(msgs), (best / baseline - 1) * 100)
+
+    context.term()
+
+
+_position = struct.Struct('>III')
+
+def journalWorker(ring, count, journalPath):
+    """ journalWorker
+    Drain count journaled jobs, committing their positions every
+    100 jobs like a bpServer worker with --batchsize 100 would.
+    """
+    cursor = SpoolCursor(journalPath, 'journal0')
+    for i in range(0, count):
+        entry    = ring.get()
+        position = _position.unpack_from(entry)[1:]
+        if i % 100 == 99 or i == count - 1:
+            cursor.commit(position)
+
+def benchJournal(options):
+    """ benchJournal
+    Time bpServer's intake: jobs arrive in batches of 50, the size
+    PulseBroker sends, and are put on a worker's ring - directly, after
+    being appended to the journal and flushed, or after being appended
+    and fsync'd.
+    """
+    rounds = int(options.rounds)
+    msgs   = benchMessages(options)
+    size   = float(sum([len(msg) for msg in msgs])) / len(msgs)
+
+    print '%d jobs, avg %0.1f bytes, in batches of 50, best of %d rounds' % (len(msgs), size, rounds)
+    print
+    print '%-14s %12s %12s %10s' % ('intake', 'jobs/sec', 'us/job', 'overhead')
+
+    baseline = None
+    for name in ('ring', 'journal', 'journal+fsync'):
+        best = None
+        for i in range(0, rounds):
+            shutil.rmtree(options.journalpath, True)
+            os.makedirs(options.journalpath)
+
+            ring    = RingBuffer()
+            journal = Spool(options.journalpath, 'journal0')
+            if name == 'ring':
+                consumer = Process(target=drain, args=(ring, len(msgs)))
+            else:
+                consumer = Process(target=journalWorker, args=(ring, len(msgs), options.journalpath))
+            consumer.start()
+
+            t = time.time()
+            for n in range(0, len(msgs), 50):
+                batch = msgs[n:n + 50]
+                if name == 'ring':
+                    for msg in batch:
+                        ring.put(msg)
+                else:
+                    positions = [journal.append(msg) for msg in batch]
+                    if name == 'journal':
+                        journal.flush()
+                    else:
+                        journal.sync(force=True)
+                    for msg, position in zip(batch, positions):
+                        ring.put(msg, prefix=_position.pack(0, *position))
+            consumer.join()
+            t = time.time() - t
+
+            journal.close()
+
+            if best is None or t < best:
+                best = t
+
+        if baseline is None:
+            baseline = best
+
+        print '%-14s %12.0f %12.2f %9.0f%%' % (name, len(msgs) / best, best * 1000000 / len(msgs), (best / baseline - 1) * 100)
+
+    shutil.rmtree(options.journalpath, True)
+
+
+benchmarks = { 'wire':    benchWire,
+               'ring':    benchRing,
+               'copies':  benchCopies,
+               'journal': benchJournal,
+             }
+
+_defaultOptions = { 'config':      ('-c', '--config',      None,           'Configuration file'),
+                    'bench':       ('',   '--bench',       'wire',         'Which benchmark to run'),
+                    'archive':     ('',   '--archive',     None,           'Archive file to read recorded jobs from'),
+                    'count':       ('',   '--count',       '10000',        'Maximum number of recorded jobs to use'),
+                    'rounds':      ('',   '--rounds',      '3',            'How many times each benchmark is repeated'),
+                    'journalpath': ('',   '--journalpath', '/tmp/bpbench', 'Directory the journal benchmark writes to'),
+                  }
+
+if __name__ == '__main__':
+    options = initOptions(params=_defaultOptions)
+
+    if options.bench not in benchmarks:
+        print 'unknown benchmark %s, choose from: %s' % (options.bench, ', '.join(sorted(benchmarks.keys())))
+        sys.exit(2)
+
+    benchmarks[options.bench](options)
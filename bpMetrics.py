@@ -28,6 +28,14 @@
         -b --background     Fork to a daemon process
                             default: False
            --graphite       host:port where Graphite's carbon-cache service is running
+           --draintime      Seconds the worker is given to finish after a SIGTERM
+                            before it is killed
+                            default: 30
+
+    SIGTERM drains the server: it stops taking metrics, removes itself
+    from the list of active servers and the worker handles what is left
+    in its ring and sends the counts of every interval, finished or not,
+    before it exits.  What was flushed is logged.
 
     Sample Configuration file
 
@@ -41,81 +49,118 @@
 """
 
 import os, sys
-import json
 import time
+import signal
 import socket
 import logging
 
 from Queue import Empty
-from multiprocessing import Process, Queue, current_process, get_logger, log_to_stderr
+from multiprocessing import Process, Event, current_process, get_logger, log_to_stderr
 
 import zmq
 
 from releng import initOptions, initLogs, dbRedis
 from releng.metrics import Metric
+from releng.wire import negotiate, decodeMetrics
+from releng.ring import RingBuffer
 from releng.constants import PORT_METRICS, ID_METRICS_WORKER, \
-                             METRICS_COUNT, METRICS_HASH, METRICS_KEY, METRICS_LIST, METRICS_SET
+                             METRICS_COUNT, METRICS_HASH, METRICS_KEY, METRICS_LIST, METRICS_SET, METRICS_TIMER
+
 
+log            = get_logger()
+jobQueue       = RingBuffer()
+drainRequested = False
 
-log      = get_logger()
-jobQueue = Queue()
+DRAIN_TIME = 30     # seconds a SIGTERM drain may take before the worker is killed
+POLL_TIME  = 100    # milliseconds the main loop waits for a request
 
 
-def worker(jobQueue, graphite, db):
+def worker(jobQueue, graphite, db, stopping=None):
     log.info('starting')
 
     metrics = Metric(graphite, db)
+    drained = None      # messages handled since stopping was set, None until then
 
     while True:
+        if drained is None and stopping is not None and stopping.is_set():
+            log.info('draining %d bytes of metrics' % jobQueue.used())
+            drained = 0
+
         try:
             job = jobQueue.get(False)
         except Empty:
             job = None
+            if drained is not None:
+                break
 
         if job is not None:
+            if drained is not None:
+                drained += 1
+
             try:
-                jobs = json.loads(job)
-
-                for item in jobs:
-                    metric, data = item
-                    if metric == METRICS_COUNT:
-                        group = data[0]
-                        key   = data[1]
-
-                        metrics.count('count')
-                        metrics.count(group)
-                        metrics.count('%s.%s' % (group, key))
-
-                    elif metric == METRICS_LIST:
-                        metrics.count('list')
-                        if len(data) == 2:
-                            key   = data[0]
-                            value = data[1]
-                            db.rpush(key, value)
-
-                    elif metric == METRICS_SET:
-                        metrics.count('set')
-                        if len(data) == 2:
-                            key   = data[0]
-                            value = data[1]
-                            db.sadd(key, value)
-
-                    elif metric == METRICS_HASH:
-                        metrics.count('hash')
-                        if len(data) == 3:
-                            hash  = data[0]
+                jobs = decodeMetrics(job)
+
+                with db.pipeline() as pipe:
+                    for item in jobs:
+                        metric, data = item
+                        if metric == METRICS_COUNT:
+                            group = data[0]
+                            key   = data[1]
+
+                            metrics.count('count')
+                            metrics.count(group)
+                            metrics.count('%s.%s' % (group, key))
+
+                        elif metric == METRICS_TIMER:
+                            group = data[0]
                             key   = data[1]
                             value = data[2]
-                            db.hset(hash, key, value)
-                            db.sadd('metrics.hashes', hash)
+
+                            metrics.count('timer')
+                            metrics.count('%s.%s' % (group, key), value)
+
+                        elif metric == METRICS_LIST:
+                            metrics.count('list')
+                            if len(data) == 2:
+                                key   = data[0]
+                                value = data[1]
+                                pipe.rpush(key, value)
+
+                        elif metric == METRICS_SET:
+                            metrics.count('set')
+                            if len(data) == 2:
+                                key   = data[0]
+                                value = data[1]
+                                pipe.sadd(key, value)
+
+                        elif metric == METRICS_HASH:
+                            metrics.count('hash')
+                            if len(data) == 3:
+                                hash  = data[0]
+                                key   = data[1]
+                                value = data[2]
+                                pipe.hset(hash, key, value)
+                                pipe.sadd('metrics.hashes', hash)
 
             except:
                 log.error('Error converting incoming job', exc_info=True)
 
             metrics.check()
 
+    # the counts of the intervals still open would be lost otherwise
+    flushed = metrics.check(force=True)
+
+    log.info('drained %d messages, %d interval counts flushed' % (drained, flushed))
     log.info('done')
 
+def requestDrain(signum, frame):
+    """ requestDrain
+    SIGTERM handler, the main loop notices the flag between requests
+    and starts the drain.
+    """
+    global drainRequested
+    drainRequested = True
+
 
 _defaultOptions = { 'config':      ('-c', '--config',      None,             'Configuration file'),
                     'debug':       ('-d', '--debug',       True,             'Enable Debug', 'b'),
@@ -124,7 +169,8 @@ _defaultOptions = { 'config':      ('-c', '--config',      None,             'Co
                     'redis':       ('-r', '--redis',       'localhost:6379', 'Redis connection string'),
                     'redisdb':     ('',   '--redisdb',     '8',              'Redis database'),
                     'address':     ('',   '--address' ,    None,             'IP Address'),
-                    'graphite':    ('',   '--graphite',    None,             "host:port where Graphite's carbon-cache service is running")
+                    'graphite':    ('',   '--graphite',    None,             "host:port where Graphite's carbon-cache service is running"),
+                    'draintime':   ('',   '--draintime',   DRAIN_TIME,       'Seconds the worker is given to drain after a SIGTERM'),
                   }
 
 if __name__ == '__main__':
@@ -140,9 +186,24 @@ if __name__ == '__main__':
     log.info('Connecting to datastore')
     db = dbRedis(options)
 
+    try:
+        drainTime = max(0, float(options.draintime))
+    except:
+        log.error('invalid draintime value [%s] - using default of %d' % (options.draintime, DRAIN_TIME))
+        drainTime = DRAIN_TIME
+
     if db.ping():
+        stopping = Event()
+
+        # the drain is run from here, a SIGTERM sent to the whole
+        # process group must not cut the worker short
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
         log.info('Creating processes')
-        Process(name='worker', target=worker, args=(jobQueue, options.graphite, db)).start()
+        p = Process(name='worker', target=worker, args=(jobQueue, options.graphite, db, stopping))
+        p.start()
+
+        signal.signal(signal.SIGTERM, requestDrain)
 
         if ':' not in options.address:
             options.address = '%s:%s' % (options.address, PORT_METRICS)
@@ -158,27 +219,60 @@ if __name__ == '__main__':
         log.info('Adding %s to the list of active servers' % server.identity)
         db.rpush(ID_METRICS_WORKER, server.identity)
 
-        while True:
+        poller = zmq.Poller()
+        poller.register(server, zmq.POLLIN)
+
+        while not drainRequested:
             try:
-                request = server.recv_multipart()
+                items = dict(poller.poll(POLL_TIME))
+            except:
+                log.error('error raised during poll()', exc_info=True)
+                break
+
+            if server not in items:
+                continue
+
+            # the payload frame is copied from ZeroMQ's memory
+            # straight into the worker's ring
+            try:
+                request = server.recv_multipart(copy=False)
             except:
                 log.error('error raised during recv_multipart()', exc_info=True)
                 break
 
             # [ destination, sequence, control, payload ]
-            address, sequence, control = request[:3]
-            reply = [address, sequence]
+            # [ destination, sequence, 'ping', formats ]
+            address, sequence = request[:2]
+            control           = request[2].bytes
+            reply             = [address, sequence]
 
             if control == 'ping':
                 reply.append('pong')
+                if len(request) > 3:
+                    reply.append(negotiate(request[3].bytes))
             else:
                 reply.append('ok')
                 jobQueue.put(request[3])
 
             server.send_multipart(reply)
 
-        log.info('Removing ourselves to the list of active servers')
+        log.info('Removing ourselves from the list of active servers')
         db.lrem(ID_METRICS_WORKER, 0, server.identity)
+
+        server.close()
+
+        draining = time.time()
+        left     = jobQueue.used()
+
+        stopping.set()
+        p.join(drainTime)
+
+        if p.is_alive():
+            log.error('worker did not finish draining in time, killing it with %d bytes of metrics in its ring' % jobQueue.used())
+            os.kill(p.pid, signal.SIGKILL)
+            p.join()
+
+        log.info('drain of %d bytes of metrics finished in %0.2fs' % (left, time.time() - draining))
     else:
         log.error('Unable to reach the database')
 
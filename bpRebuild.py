@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" bpRebuild
+
+    rebuild bpServer's Redis state from its job archives
+
+    :copyright: (c) 2012 by Mozilla
+    :license: MPLv2
+
+    Assumes Python v2.6+
+
+    Usage
+        bpRebuild.py [options] archive|directory [...]
+
+        -c --config         Configuration file (json format)
+                            default: None
+        -r --redis          Redis server connection string
+                            default: localhost:6379
+           --redisdb        Redis database ID
+                            default: 8
+           --processes      How many archives are loaded at the same time
+                            default: number of CPUs
+           --batchsize      Jobs whose Redis writes are sent in one pipeline
+                            default: 1000
+           --dryrun         Read and process the archives but do not write
+                            anything to Redis
+                            default: False
+
+    Each archive is loaded by one process using bpServer's own job
+    handling, so the job:, build:, change: and build:slave:jobs: keys
+    and the index: sorted sets come out the same as if the jobs had
+    arrived live.  The writes of a batch are coalesced, see dbBatch.
+    A directory stands for every bp_archive_* file in it.
+
+    A job can start in one archive and finish in the next, so the
+    archives are loaded in passes that do not depend on which process
+    gets to a job first:
+
+        1   every event but the finished ones
+        2   the finished events, which read the start time of their
+            job back from Redis for its elapsed time and index score
+        3   every build written to is scored in index:build by the
+            latest start of its jobs
+
+    With --dryrun the start times are not there to be read back and
+    the third pass is skipped.
+
+    Sample Configuration file
+
+        { 'redis': 'localhost:6379',
+          'processes': 4
+        }
+
+    Authors:
+        bear    Mike Taylor <bear@mozilla.com>
+"""
+
+import os, sys
+import glob
+import time
+
+from multiprocessing import Pool, cpu_count
+
+from releng import initOptions, dbRedis, dbBatch
+from releng.cache import LRUCache
+from releng.archive import ArchiveReader
+from releng.constants import INDEX_BUILD, INDEX_JOB
+from bpServer import handleJob
+
+
+BATCH_SIZE = 1000
+
+
+def findArchives(paths):
+    """ findArchives
+    Expand directories to the archives in them, a .blk archive is
+    listed once even though its .idx file matches too.
+    """
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(glob.glob(os.path.join(path, 'bp_archive_*.blk')) +
+                           glob.glob(os.path.join(path, 'bp_archive_*.dat')))
+        else:
+            files = [path]
+
+        for filename in files:
+            if filename not in result:
+                result.append(filename)
+
+    return result
+
+def isFinished(job):
+    return job.get('event') == 'build' and job['pulse_key'].split('.')[-1] == 'finished'
+
+def loadArchive(args):
+    """ loadArchive
+    Replay the finished events of one archive into Redis, or all the
+    others, returns (filename, jobs, errors, seconds, builds) - builds
+    being the build keys written to index:build.
+    """
+    filename, options, batchSize, finishing = args
+
+    db      = dbRedis(options)
+    pipe    = db.pipeline()
+    writes  = dbBatch()
+    started = LRUCache(0)   # start times are read back from Redis
+    builds  = set()
+    batch   = 0
+    count   = 0
+    errors  = 0
+    t       = time.time()
+
+    if options.dryrun:
+        lookup = None
+    else:
+        lookup = db
+
+    for job in ArchiveReader(filename).jobs():
+        if isFinished(job) != finishing:
+            continue
+
+        try:
+            handleJob(job, writes, started, lookup)
+            count += 1
+        except:
+            errors += 1
+
+        batch += 1
+        if batch >= batchSize:
+            builds.update(writes.zsets.get(INDEX_BUILD, {}))
+            writes.apply(pipe)
+            if options.dryrun:
+                pipe.reset()
+            else:
+                pipe.execute()
+            batch = 0
+
+    builds.update(writes.zsets.get(INDEX_BUILD, {}))
+    writes.apply(pipe)
+    if options.dryrun:
+        pipe.reset()
+    else:
+        pipe.execute()
+
+    return filename, count, errors, time.time() - t, builds
+
+def scoreBuilds(db, builds, batchSize):
+    """ scoreBuilds
+    Score each of builds in index:build by the latest index:job score
+    of its jobs, whichever order the passes wrote them in.
+    """
+    builds = sorted(builds)
+    pipe   = db.pipeline()
+
+    for n in range(0, len(builds), batchSize):
+        chunk = builds[n:n + batchSize]
+
+        for buildKey in chunk:
+            pipe.smembers(buildKey)
+        members = pipe.execute()
+
+        jobKeys = []
+        for jobs in members:
+            jobKeys.append(sorted(jobs))
+            for jobKey in jobKeys[-1]:
+                pipe.zscore(INDEX_JOB, jobKey)
+        scores = pipe.execute()
+
+        latest = {}
+        i      = 0
+        for buildKey, jobs in zip(chunk, jobKeys):
+            found = [score for score in scores[i:i + len(jobs)] if score is not None]
+            if len(found) > 0:
+                latest[buildKey] = max(found)
+            i += len(jobs)
+
+        if len(latest) > 0:
+            pipe.zadd(INDEX_BUILD, latest)
+            pipe.execute()
+
+
+_defaultOptions = { 'config':    ('-c', '--config',    None,             'Configuration file'),
+                    'redis':     ('-r', '--redis',     'localhost:6379', 'Redis connection string'),
+                    'redisdb':   ('',   '--redisdb',   '8',              'Redis database'),
+                    'processes': ('',   '--processes', None,             'How many archives are loaded at the same time'),
+                    'batchsize': ('',   '--batchsize', BATCH_SIZE,       'Jobs whose Redis writes are sent in one pipeline'),
+                  }
+
+if __name__ == '__main__':
+    options = initOptions(params=_defaultOptions)
+
+    archives = findArchives(options.args)
+    if len(archives) == 0:
+        print 'no archives found'
+        sys.exit(2)
+
+    try:
+        processes = max(1, int(options.processes))
+    except:
+        processes = cpu_count()
+
+    try:
+        batchSize = max(1, int(options.batchsize))
+    except:
+        print 'invalid batchsize value [%s] - using default of %d' % (options.batchsize, BATCH_SIZE)
+        batchSize = BATCH_SIZE
+
+    db = dbRedis(options)
+    if not options.dryrun and not db.ping():
+        print 'Unable to reach the database'
+        sys.exit(1)
+
+    print 'loading %d archives with %d processes' % (len(archives), min(processes, len(archives)))
+
+    pool   = Pool(min(processes, len(archives)))
+    total  = 0
+    builds = set()
+    t      = time.time()
+
+    for finishing, kind in ((False, 'other'), (True, 'finished')):
+        work = [(filename, options, batchSize, finishing) for filename in archives]
+
+        for filename, count, errors, elapsed, written in pool.imap_unordered(loadArchive, work):
+            total += count
+            builds.update(written)
+            print '%s: %d %s jobs in %0.2fs, %0.0f jobs/sec, %d errors' % (filename, count, kind, elapsed,
+                                                                          count / max(elapsed, 0.001), errors)
+
+    pool.close()
+    pool.join()
+
+    if not options.dryrun:
+        scoreBuilds(db, builds, batchSize)
+        print 'scored %d builds' % len(builds)
+
+    elapsed = time.time() - t
+
+    print '%d jobs from %d archives in %0.2fs, %0.0f records/sec' % (total, len(archives), elapsed, total / max(elapsed, 0.001))
@@ -27,13 +27,60 @@
                             default: None
            --archivepath    Path where incoming jobs are to be archived
                             default: None
+           --journalpath    Path where accepted jobs are journaled until a
+                            worker has written them to Redis, jobs a worker
+                            did not finish are replayed on the next start
+                            default: None
+           --archivesync    Milliseconds between fsyncs of the archive, jobs
+                            archived in between share one fsync, 0 to disable
+                            default: 0
+           --workers        How many worker processes jobs are sharded across,
+                            all the jobs of a build go to the same worker
+                            default: 1
+           --batchsize      Most jobs whose Redis writes are sent in one pipeline
+                            default: 1
+           --batchtime      Milliseconds a partial Redis pipeline waits for more jobs
+                            default: 100
+           --dedupe         Seconds a job's message id is remembered so
+                            redelivered or resent jobs are skipped, 0 to disable
+                            default: 900
+           --startcache     How many started jobs each worker remembers so
+                            their finished event does not read Redis
+                            default: 10000
+           --startttl       Seconds a started job is remembered for
+                            default: 21600
+           --highwater      Percentage of a worker's ring in use at which
+                            jobs are refused with a busy reply
+                            default: 75
+           --lowwater       Percentage the rings have to drain to before
+                            jobs are accepted again
+                            default: 25
+           --draintime      Seconds the workers are given to finish the jobs
+                            they hold after a SIGTERM before they are killed
+                            default: 30
+           --indexdays      Days of builds, jobs and changes kept in the
+                            time indexes, 0 to keep everything
+                            default: 30
         -b --background     Fork to a daemon process
                             default: False
 
+    SIGTERM drains the server: jobs are refused with a busy reply so
+    the broker sends them elsewhere, the server removes itself from the
+    list of active servers and the workers finish what is in their rings,
+    send their last pipelines, close their archives and commit their
+    journals.  Their last metrics are sent on and a report of what was
+    flushed, and of anything left behind at the deadline, is logged.
+
+    A worker that dies is started again and with journals the jobs it
+    had not written to Redis are replayed to it.  A worker that keeps
+    dying drains the server the same way and it exits with status 1.
+    Failed Redis writes are sent again until they succeed.
+
     Sample Configuration file
 
         { 'debug': True,
-          'logpath': '.'
+          'logpath': '.',
+          'workers': 4
         }
 
     Authors:
@@ -41,29 +88,69 @@
 """
 
 import os, sys
+import re
 import time
-import json
+import zlib
+import struct
+import signal
 import socket
 import logging
 
-from datetime import date, datetime
-from Queue import Empty
-from multiprocessing import Process, Queue, current_process, get_logger, log_to_stderr
+from Queue import Empty, Full
+from multiprocessing import Process, Event, Queue, current_process, get_logger, log_to_stderr
 
 import zmq
 
-from releng import initOptions, initLogs, dbRedis
-from releng.constants import PORT_PULSE, ID_PULSE_WORKER, ID_METRICS_WORKER, \
-                             METRICS_COUNT, METRICS_HASH, METRICS_LIST, METRICS_SET
-
-log         = get_logger()
-jobQueue    = Queue()
-metricQueue = Queue()
-
-ARCHIVE_CHUNK = 100
-
-
-def metric(jobs, options):
+from releng import initOptions, initLogs, dbRedis, dbBatch
+from releng.wire import WIRE_JSON, WIRE_KEYS, formats, preferred, negotiate, keysOffered, decodeJob, routeKey, \
+                        encodeMetrics, transcodeMetrics
+from releng.ring import RingBuffer
+from releng.spool import Spool, SpoolCursor
+from releng.archive import ArchiveWriter
+from releng.cache import TTLCache
+from releng.handlers import Handler, Registry
+from releng.isotime import parseTimestamp
+from releng.timeindex import trimBefore, INDEX_DAYS
+from releng.dedupe import Dedupe, DEDUPE_WINDOW
+from releng.constants import PORT_PULSE, ID_PULSE_WORKER, ID_METRICS_WORKER, PULSE_PROPERTIES, \
+                             INDEX_BUILD, INDEX_JOB, INDEX_CHANGE, \
+                             METRICS_COUNT, METRICS_HASH, METRICS_LIST, METRICS_SET, METRICS_TIMER
+
+log            = get_logger()
+jobQueues      = []
+journals       = []
+metricQueue    = None
+dropped        = 0
+drainRequested = False
+drainReason    = 'SIGTERM received'
+
+ARCHIVE_SYNC  = 0    # milliseconds between archive fsyncs, 0 to disable
+WORKERS       = 1    # worker processes jobs are sharded across
+BATCH_SIZE    = 1    # jobs whose Redis writes share a pipeline
+BATCH_TIME    = 100  # milliseconds a partial pipeline waits for more jobs
+WORKER_IDLE   = 1    # seconds the worker blocks waiting for a job
+START_CACHE   = 10000     # started jobs remembered by each worker
+START_TTL     = 6 * 3600  # seconds a started job is remembered for
+HIGH_WATER    = 75   # percent of a worker ring in use before jobs are refused
+LOW_WATER     = 25   # percent the rings drain to before jobs are taken again
+DRAIN_TIME    = 30   # seconds a SIGTERM drain may take before the workers are killed
+WRITE_RETRY   = 5    # seconds a worker waits before sending a failed pipeline again
+RESTARTS      = 5    # times a worker that died is started again before the server stops
+POLL_TIME     = 100  # milliseconds the main loop waits for a request
+REPORT_TIME   = 60   # seconds between reports of the event handlers' timings
+TRIM_TIME     = 3600 # seconds between trims of the time indexes
+
+_position = struct.Struct('>III')   # journal, segment, offset in front of journaled jobs
+
+
+def metric(jobs, options, stopping=None, results=None):
+    """ metric
+    Send the metrics the workers report to bpMetrics.
+
+    Once stopping is set whatever is left in the ring is sent and the
+    process exits, the count of metrics sent meanwhile and the bytes
+    that could not be sent go to results.
+    """
     log.info('starting')
 
     db = dbRedis(options)
@@ -75,8 +162,13 @@ def metric(jobs, options):
 
     remoteID = None
     sequence = 0
+    fmt      = WIRE_JSON
+    drained  = None     # metrics sent since stopping was set, None until then
 
     while True:
+        if drained is None and stopping is not None and stopping.is_set():
+            drained = 0
+
         if remoteID is None:
             for serverID in db.lrange(ID_METRICS_WORKER, 0, -1):
                 if not db.sismember('%s:inactive' % ID_METRICS_WORKER, serverID):
@@ -92,18 +184,33 @@ def metric(jobs, options):
                     router.connect(address)
                     time.sleep(0.1)
 
-        try:
-            job = jobs.get(False)
-        except Empty:
+                    # offer our wire formats, metrics go as json until the pong
+                    sequence += 1
+                    router.send_multipart([remoteID, str(sequence), 'ping', ' '.join(formats())])
+                    break
+
+        # metrics stay queued until there is a server to send them to
+        if remoteID is None:
             job = None
+        else:
+            try:
+                job = jobs.get(False)
+            except Empty:
+                job = None
+
+        if job is None and drained is not None:
+            break
 
         if job is not None:
-            msg = json.dumps(job)
+            if drained is not None:
+                drained += 1
+
+            msg = transcodeMetrics(job, fmt)
             sequence += 1
             payload   = [remoteID, str(sequence), 'job', msg]
 
             if options.debug:
-                log.debug('send %s %d chars [%s]' % (remoteID, len(msg), msg[:42]))
+                log.debug('send %s %d chars [%r]' % (remoteID, len(msg), msg[:42]))
 
             router.send_multipart(payload)
 
@@ -115,194 +222,591 @@ def metric(jobs, options):
         if router in items:
             reply = router.recv_multipart()
 
+            # [ remoteID, sequence, 'pong', format ]
+            if reply[2] == 'pong' and len(reply) > 3:
+                log.info('sending metrics to %s as %s' % (remoteID, reply[3]))
+                fmt = reply[3]
+
+    # give the last sends a moment to leave before the socket goes
+    router.setsockopt(zmq.LINGER, 1000)
+    router.close()
+    context.term()
+
+    if drained is not None:
+        log.info('drained %d metrics, %d bytes left unsent' % (drained, jobs.used()))
+        if results is not None:
+            results.put((current_process().name, drained, jobs.used()))
+
     log.info('done')
 
 
-def getArchive(archivePath):
+def getArchive(archivePath, shard=None, archiveSync=ARCHIVE_SYNC):
+    """ getArchive
+    Start the thread that archives a worker's jobs, None if there
+    is no archive path.
+    """
     if archivePath is not None and os.path.isdir(archivePath):
-        d      = date.today()
-        s      = os.path.join(archivePath, 'bp_archive_%s.dat' % d.strftime("%Y%m%d"))
-        result = open(s, 'a+')
-        log.info('archiving to %s' % s)
+        result = ArchiveWriter(archivePath, shard, syncInterval=archiveSync / 1000.0)
+        result.start()
     else:
         result = None
 
     return result
 
-def worker(jobs, metrics, db, archivePath):
+def putMetrics(metrics, items):
+    """ putMetrics
+    Hand a batch of metrics to the metric process.  If its ring is
+    full, most likely because no metrics server is reachable, the
+    batch is dropped rather than stalling the worker.
+    """
+    global dropped
+
+    try:
+        metrics.put(encodeMetrics(items, preferred()), False)
+    except Full:
+        dropped += 1
+        if dropped % 1000 == 1:
+            log.warning('metrics ring is full, %d batches dropped so far' % dropped)
+
+def flushWrites(pipe, metrics, count, writes=None):
+    """ flushWrites
+    Send the Redis writes queued for count jobs in one round trip
+    and report how long it took.  The writes of a dbBatch are
+    coalesced onto pipe first and only cleared once Redis has them.
+    Returns False if the writes failed, a dbBatch then still holds
+    them to be sent again, writes queued on pipe itself are lost.
+    """
+    if writes is None:
+        declared = len(pipe)
+    else:
+        declared = len(writes)
+        writes.apply(pipe, clear=False)
+
+    commands = len(pipe)
+    t        = time.time()
+
+    try:
+        pipe.execute()
+    except:
+        log.error('error writing %d jobs to Redis, retrying in %ds' % (count, WRITE_RETRY), exc_info=True)
+        pipe.reset()
+        putMetrics(metrics, [(METRICS_COUNT, ('redis', 'error'))])
+        return False
+
+    if writes is not None:
+        writes.clear()
+
+    ms = (time.time() - t) * 1000
+
+    log.debug('Redis: %d jobs %d writes as %d commands in %0.1fms' % (count, declared, commands, ms))
+
+    putMetrics(metrics, [(METRICS_TIMER, ('redis', 'batch',    ms)),
+                         (METRICS_TIMER, ('redis', 'jobs',     count)),
+                         (METRICS_TIMER, ('redis', 'writes',   declared)),
+                         (METRICS_TIMER, ('redis', 'commands', commands)),
+                        ])
+
+    return True
+
+def masterName(item):
+    """ masterName
+    Short name of the master a job came from, buildbot-master01
+    for buildbot-master01.build.mozilla.org:/builds
+    """
+    return item['master'].partition(':')[0].partition('.')[0]
+
+class ChangeHandler(Handler):
+    """source events, the change builds are made from."""
+    def handle(self, item, pipe, started, db):
+        pNames     = PULSE_PROPERTIES
+        properties = { 'revision':  None,
+                       'builduid':  None,
+                     }
+        try:
+            for p in item['pulse']['payload']['change']['properties']:
+                pName, pValue, _ = p
+                if pName in pNames:
+                    properties[pName] = pValue
+        except:
+            log.error('exception extracting properties from build step', exc_info=True)
+
+        if properties['revision'] is None:
+            properties['revision'] = item['pulse']['payload']['change']['revision']
+
+        builduid  = properties['builduid']
+        changeKey = 'change:%s' % builduid
+
+        fields = { 'master':   masterName(item),
+                   'comments': item['pulse']['payload']['change']['comments'],
+                   'project':  item['pulse']['payload']['change']['project'],
+                   'branch':   item['pulse']['payload']['change']['branch'],
+                 }
+        fields.update(properties)
+
+        pipe.hmset(changeKey, fields)
+
+        pipe.zadd(INDEX_CHANGE, { changeKey: parseTimestamp(item['time']).epoch })
+
+        return []
+
+class SlaveHandler(Handler):
+    """slave connect and disconnect events, they are only counted."""
+    def __init__(self, group):
+        Handler.__init__(self)
+        self.group = group
+
+    def handle(self, item, pipe, started, db):
+        return [(METRICS_COUNT, (self.group, item['slave']))]
+
+class BuildHandler(Handler):
+    """build events, the job record, the build it belongs to and the
+    slave's recent jobs.  Sub-events that know more subclass it and
+    override update().
+
+    A job is indexed under when it started, so only the sub-events
+    that know that index it - later ones like log_uploaded would
+    otherwise move it to whenever they happened.
+    """
+    def handle(self, item, pipe, started, db):
+        buildEvent = item['pulse_key'].split('.')[-1]
+        slave      = item['slave']
+        master     = masterName(item)
+        pNames     = PULSE_PROPERTIES
+        outbound   = []
+        properties = { 'branch':    None,
+                       'product':   None,
+                       'revision':  None,
+                       'builduid':  None,
+                     }
+        try:
+            for p in item['pulse']['payload']['build']['properties']:
+                pName, pValue, _ = p
+                if pName in pNames:
+                    properties[pName] = pValue
+        except:
+            log.error('exception extracting properties from build step', exc_info=True)
+
+        product = properties['product']
+
+        if product in ('seamonkey',):
+            log.debug('skipping %s %s' % (product, item['event']))
+            return outbound
+
+        builduid = properties['builduid']
+        number   = properties['buildnumber']
+        buildKey = 'build:%s'     % builduid
+        jobKey   = 'job:%s.%s.%s' % (builduid, master, number)
+
+        fields = { 'slave':   slave,
+                   'master':  master,
+                   'results': item['pulse']['payload']['build']['results'],
+                 }
+        fields.update(properties)
+
+        pipe.lpush('build:slave:jobs:%s' % slave, jobKey)
+        pipe.ltrim('build:slave:jobs:%s' % slave, 0, 20)
+
+        log.debug('%s results %s' % (jobKey, item['pulse']['payload']['build']['results']))
+
+        outbound.append((METRICS_COUNT, ('build', buildEvent)))
+
+        ts = self.update(item, jobKey, fields, outbound, started, db)
+
+        pipe.hmset(jobKey, fields)
+        pipe.sadd(buildKey, jobKey)
+
+        if ts is not None:
+            epoch = parseTimestamp(ts).epoch
+            pipe.zadd(INDEX_JOB,   { jobKey:   epoch })
+            pipe.zadd(INDEX_BUILD, { buildKey: epoch })
+
+        return outbound
+
+    def update(self, item, jobKey, fields, outbound, started, db):
+        """Add what the sub-event knows to fields and outbound and
+        return the timestamp the job is indexed under, None to leave
+        the index alone.
+        """
+        return None
+
+class BuildStarted(BuildHandler):
+    def update(self, item, jobKey, fields, outbound, started, db):
+        fields['started'] = item['time']
+        started.put(jobKey, fields)
+
+        outbound.append((METRICS_COUNT, ('build:started:slave',   fields['slave']  )))
+        outbound.append((METRICS_COUNT, ('build:started:master',  fields['master'] )))
+        outbound.append((METRICS_COUNT, ('build:started:branch',  fields['branch'] )))
+        outbound.append((METRICS_COUNT, ('build:started:product', fields['product'])))
+
+        return item['time']
+
+class BuildFinished(BuildHandler):
+    """Works out how long the job took from when it started, which is
+    also the timestamp the job stays indexed under.  A job whose start
+    was never seen is indexed under when it finished.
+    """
+    def update(self, item, jobKey, fields, outbound, started, db):
+        outbound.append((METRICS_COUNT, ('build:finished:slave',   fields['slave']  )))
+        outbound.append((METRICS_COUNT, ('build:finished:master',  fields['master'] )))
+        outbound.append((METRICS_COUNT, ('build:finished:branch',  fields['branch'] )))
+        outbound.append((METRICS_COUNT, ('build:finished:product', fields['product'])))
+
+        # if started time is found, use that for the key
+        known = started.pop(jobKey)
+        if known is not None:
+            tStart = known.get('started')
+            outbound.append((METRICS_COUNT, ('cache', 'hit')))
+        else:
+            tStart = None
+            outbound.append((METRICS_COUNT, ('cache', 'miss')))
+
+        if tStart is None and db is not None:
+            tStart = db.hget(jobKey, 'started')
+        if tStart is None:
+            secElapsed = 0
+            ts         = item['time']
+        else:
+            ts         = tStart
+            secElapsed = int(parseTimestamp(item['time']).epoch - parseTimestamp(tStart).epoch)
+
+        fields['finished'] = item['time']
+        fields['elapsed']  = secElapsed
+
+        return ts
+
+# adding an event is a matter of registering a handler for it
+handlers = Registry()
+handlers.register('source',           None,           ChangeHandler())
+handlers.register('slave connect',    None,           SlaveHandler('connect:slave'))
+handlers.register('slave disconnect', None,           SlaveHandler('disconnect:slave'))
+handlers.register('build',            None,           BuildHandler())
+handlers.register('build',            'started',      BuildStarted())
+handlers.register('build',            'finished',     BuildFinished())
+handlers.register('build',            'log_uploaded', BuildHandler())   # request_ids come with the properties
+
+def handleJob(item, pipe, started, db=None):
+    """ handleJob
+    Queue the Redis writes for one decoded job on pipe, a dbPipeline
+    or a dbBatch, and return the metrics it generates.
+
+    The job goes to the handler registered for its event and
+    sub-event, the last part of its pulse key, see handlers.
+
+    started is an LRUCache of the fields written for recently started
+    jobs, keyed by jobKey, so a finished event does not have to read
+    the start time back.  On a miss it is read from db, unless db is
+    None.
+    """
+    outbound  = [(METRICS_COUNT, ('metrics', 'pulse'))]
+    outbound += handlers.dispatch(item['event'], item['pulse_key'].split('.')[-1], item, pipe, started, db)
+
+    return outbound
+
+def worker(jobs, metrics, db, archivePath, dedupeWindow, batchSize=BATCH_SIZE, batchTime=BATCH_TIME, shard=None,
+           archiveSync=ARCHIVE_SYNC, startCache=START_CACHE, startTTL=START_TTL, journalPath=None,
+           stopping=None, results=None):
+    """ worker
+    Turn jobs into Redis writes.
+
+    The writes for each job are collected in a dbBatch that is sent
+    as one pipeline once batchSize jobs are on it or batchTime ms
+    after the first one, whichever comes first.  Writes to the same
+    key by different jobs of a batch share one command.
+
+    Every REPORT_TIME seconds the calls and latencies of each
+    event handler are sent as handler:<event>.<sub-event> metrics.
+
+    When there is more than one worker each one is given a shard
+    number and archives to its own bp_archive_YYYYMMDD.<shard>.blk
+
+    Started jobs are remembered for startTTL seconds, at most
+    startCache of them, and the cache hits and misses of finished
+    events are sent as the cache.hit and cache.miss metrics.
+
+    With a journalPath each job comes with its position in one of the
+    journals, see accept().  The positions are committed once the
+    pipeline holding the job's writes has been sent.
+
+    Once stopping is set the worker stops waiting for jobs: what is
+    left in its ring is handled, the last pipeline sent, the journal
+    positions committed and the archive closed before it exits.  How
+    many jobs and pipelines that took goes to results.
+
+    Archiving is done by a separate thread, see ArchiveWriter.
+    """
     log.info('starting')
 
-    aCount  = 0
-    archive = getArchive(archivePath)
-
-    pNames = ('branch', 'product', 'platform', 'revision', 'request_ids',
-              'builduid', 'buildnumber', 'buildid', 'statusdb_id',
-              'build_url', 'log_url', 'pgo_build', 'scheduler', 'who',
-             )
+    archive = getArchive(archivePath, shard, archiveSync)
+
+    pipe      = db.pipeline()
+    writes    = dbBatch()
+    batch     = 0       # jobs whose writes are in writes
+    reportAt  = time.time() + REPORT_TIME
+    deadline  = None
+    started   = TTLCache(startCache, startTTL)
+    cursors   = {}      # journal -> SpoolCursor
+    done      = {}      # journal -> position of the last job handled
+    drained   = None    # jobs handled since stopping was set, None until then
+    flushes   = 0       # pipelines sent since stopping was set
+    empty     = False   # the ring ran dry while draining
+    batchTime = batchTime / 1000.0
+
+    if dedupeWindow > 0:
+        dedupe = Dedupe(window=dedupeWindow)
+    else:
+        dedupe = None
 
     while True:
+        if batch > 0 and (empty or batch >= batchSize or time.time() >= deadline):
+            # the batch is sent until Redis takes it, meanwhile no more
+            # jobs are taken off the ring and none are committed in the
+            # journal, the main loop answers busy once the ring fills
+            if not flushWrites(pipe, metrics, batch, writes):
+                time.sleep(WRITE_RETRY)
+                continue
+            batch = 0
+            if drained is not None:
+                flushes += 1
+
+        if time.time() >= reportAt:
+            report = handlers.report()
+            if len(report) > 0:
+                putMetrics(metrics, report)
+            for line in handlers.summary():
+                log.debug(line)
+            reportAt = time.time() + REPORT_TIME
+
+        if batch == 0 and len(done) > 0:
+            for journal in done:
+                if journal not in cursors:
+                    cursors[journal] = SpoolCursor(journalPath, 'journal%d' % journal)
+                cursors[journal].commit(done[journal])
+            done = {}
+
+        if empty:
+            break
+
+        if drained is None and stopping is not None and stopping.is_set():
+            log.info('draining %d bytes of jobs' % jobs.used())
+            drained = 0
+
+        if drained is not None:
+            timeout = 0
+        elif batch > 0:
+            timeout = max(0, deadline - time.time())
+        else:
+            timeout = WORKER_IDLE
+
         try:
-            entry = jobs.get(False)
+            entry = jobs.get(True, timeout)
         except Empty:
             entry = None
+            empty = drained is not None
 
         if entry is not None:
+            if drained is not None:
+                drained += 1
+
+            if journalPath is not None:
+                journal, segment, offset = _position.unpack_from(entry)
+                done[journal]            = (segment, offset)
+                entry                    = entry[_position.size:]
+
             try:
-                item = json.loads(entry)
+                item = decodeJob(entry)
 
                 event    = item['event']
                 key      = item['pulse_key']
-                master   = item['master'].partition(':')[0].partition('.')[0]
                 ts       = item['time']
-                entryKey = key.split('.')[1]
+
+                # the broker resends jobs it did not see acknowledged
+                if dedupe is not None:
+                    if dedupe.seen(item['id']):
+                        log.debug('Duplicate: %s %s %s' % (event, key, item['id']))
+                        putMetrics(metrics, [(METRICS_COUNT, ('dedupe', 'hit'))])
+                        continue
 
                 log.debug('Job: %s %s %s' % (event, key, ts))
 
-                outbound = [(METRICS_COUNT, ('metrics', 'pulse'))]
-
-                if event == 'source':
-                    properties = { 'revision':  None,
-                                   'builduid':  None,
-                                 }
-                    try:
-                        for p in item['pulse']['payload']['change']['properties']:
-                            pName, pValue, _ = p
-                            if pName in pNames:
-                                properties[pName] = pValue
-                    except:
-                        log.error('exception extracting properties from build step', exc_info=True)
-
-                    if properties['revision'] is None:
-                        properties['revision'] = item['pulse']['payload']['change']['revision']
-
-                    builduid  = properties['builduid']
-                    changeKey = 'change:%s' % builduid
-
-                    db.hset(changeKey, 'master',   master)
-                    db.hset(changeKey, 'comments', item['pulse']['payload']['change']['comments'])
-                    db.hset(changeKey, 'project',  item['pulse']['payload']['change']['project'])
-                    db.hset(changeKey, 'branch',   item['pulse']['payload']['change']['branch'])
-
-                    for p in properties:
-                        db.hset(changeKey, p, properties[p])
-
-                    tsDate, tsTime = ts.split('T')
-                    tsHour         = tsTime[:2]
-
-                    db.sadd('change:%s'    % tsDate,           changeKey)
-                    db.sadd('change:%s.%s' % (tsDate, tsHour), changeKey)
-
-                elif event == 'slave connect':
-                    slave = item['slave']
-                    outbound.append((METRICS_COUNT, ('connect:slave',  slave )))
-
-                elif event == 'slave disconnect':
-                    slave = item['slave']
-                    outbound.append((METRICS_COUNT, ('disconnect:slave',  slave )))
-
-                elif event == 'build':
-                    items      = key.split('.')
-                    buildEvent = items[-1]
-                    project    = items[1]
-                    slave      = item['slave']
-                    properties = { 'branch':    None,
-                                   'product':   None,
-                                   'revision':  None,
-                                   'builduid':  None,
-                                 }
-                    try:
-                        for p in item['pulse']['payload']['build']['properties']:
-                            pName, pValue, _ = p
-                            if pName in pNames:
-                                properties[pName] = pValue
-                    except:
-                        log.error('exception extracting properties from build step', exc_info=True)
-
-                    product = properties['product']
-
-                    if product in ('seamonkey',):
-                        print 'skipping', product, event
-                    else:
-                        branch   = properties['branch']
-                        builduid = properties['builduid']
-                        number   = properties['buildnumber']
-                        buildKey = 'build:%s'     % builduid
-                        jobKey   = 'job:%s.%s.%s' % (builduid, master, number)
-
-                        db.hset(jobKey, 'slave',   slave)
-                        db.hset(jobKey, 'master',  master)
-                        db.hset(jobKey, 'results', item['pulse']['payload']['build']['results'])
-
-                        db.lpush('build:slave:jobs:%s' % slave, jobKey)
-                        db.ltrim('build:slave:jobs:%s' % slave, 0, 20)
-
-                        print jobKey, 'results', item['pulse']['payload']['build']['results']
-
-                        for p in properties:
-                            db.hset(jobKey, p, properties[p])
-
-                        outbound.append((METRICS_COUNT, ('build', buildEvent)))
-
-                        if buildEvent == 'started':
-                            db.hset(jobKey, 'started', ts)
-
-                            outbound.append((METRICS_COUNT, ('build:started:slave',   slave  )))
-                            outbound.append((METRICS_COUNT, ('build:started:master',  master )))
-                            outbound.append((METRICS_COUNT, ('build:started:branch',  branch )))
-                            outbound.append((METRICS_COUNT, ('build:started:product', product)))
-
-                        elif buildEvent == 'finished':
-                            outbound.append((METRICS_COUNT, ('build:finished:slave',   slave  )))
-                            outbound.append((METRICS_COUNT, ('build:finished:master',  master )))
-                            outbound.append((METRICS_COUNT, ('build:finished:branch',  branch )))
-                            outbound.append((METRICS_COUNT, ('build:finished:product', product)))
-
-                            # if started time is found, use that for the key
-                            tStart = db.hget(jobKey, 'started')
-                            if tStart is None:
-                                secElapsed = 0
-                                ts         = item['time']
-                            else:
-                                ts         = tStart
-                                dStarted   = datetime.strptime(tStart[:-6],       '%Y-%m-%dT%H:%M:%S')
-                                dFinished  = datetime.strptime(item['time'][:-6], '%Y-%m-%dT%H:%M:%S')
-                                tdElapsed  = dFinished - dStarted
-                                secElapsed = (tdElapsed.days * 86400) + tdElapsed.seconds
-
-                            db.hset(jobKey, 'finished', item['time'])
-                            db.hset(jobKey, 'elapsed',  secElapsed)
-
-                        elif buildEvent == 'log_uploaded':
-                            if 'request_ids' in properties:
-                                db.hset(jobKey, 'request_ids', properties['request_ids'])
-
-                        tsDate, tsTime = ts.split('T')
-                        tsHour         = tsTime[:2]
-
-                        db.sadd('build:%s'    % tsDate,           buildKey)
-                        db.sadd('build:%s.%s' % (tsDate, tsHour), buildKey)
-                        db.sadd(buildKey, jobKey)
-
-                metrics.put(outbound)
+                outbound = handleJob(item, writes, started, db)
+
+                if dedupe is not None:
+                    outbound.append((METRICS_COUNT, ('dedupe', 'miss')))
+
+                putMetrics(metrics, outbound)
+
+                batch += 1
+                if batch == 1:
+                    deadline = time.time() + batchTime
 
             except:
                 log.error('Error converting incoming job', exc_info=True)
 
             if archive is not None:
-                archive.write('%s\n' % entry)
-
-            aCount += 1
-            if aCount > ARCHIVE_CHUNK:
-                if archive is not None:
-                    archive.close()
-                archive = getArchive(archivePath)
-                aCount  = 0
+                archive.write(entry)
 
     if archive is not None:
         archive.close()
 
+    report = handlers.report()
+    if len(report) > 0:
+        putMetrics(metrics, report)
+    for line in handlers.summary():
+        log.info(line)
+
+    log.info('drained %d jobs in %d pipelines' % (drained, flushes))
+    if results is not None:
+        results.put((current_process().name, drained, flushes))
+
     log.info('done')
 
+def shardIndex(msg, key=None):
+    """ shardIndex
+    Pick the worker for a job by hashing its routing key, so every
+    job of a build is handled in order by the same worker.  Brokers
+    that send the key along save decoding the job here, for the rest
+    it is worked out from the job.
+    """
+    if len(jobQueues) == 1:
+        return 0
+
+    if key is None:
+        try:
+            key = routeKey(decodeJob(msg.bytes))
+        except:
+            log.error('unable to find the routing key of a job', exc_info=True)
+            key = ''
+
+    return (zlib.crc32(key) & 0xffffffff) % len(jobQueues)
+
+def accept(msgs, keys=None):
+    """ accept
+    Hand jobs to their workers, keys are their routing keys if the
+    broker sent them.  With journals each job is appended to its
+    worker's journal first and all of them are flushed to the OS
+    before the jobs reach a ring, and so before the 'ok' reply.
+    """
+    if keys is None:
+        keys = [None] * len(msgs)
+
+    if len(journals) == 0:
+        for msg, key in zip(msgs, keys):
+            jobQueues[shardIndex(msg, key)].put(msg)
+    else:
+        entries = []
+        for msg, key in zip(msgs, keys):
+            i = shardIndex(msg, key)
+            entries.append((i, msg, journals[i].append(msg)))
+
+        for i in set([entry[0] for entry in entries]):
+            journals[i].flush()
+
+        for i, msg, position in entries:
+            jobQueues[i].put(msg, prefix=_position.pack(i, *position))
+
+def openJournals(journalPath, workers):
+    """ openJournals
+    Open a journal per worker and queue the jobs no worker finished
+    before the last shutdown.  Journals left behind by a larger set of
+    workers are replayed as well, journal i by worker i % workers.
+    """
+    names = set(['journal%d' % i for i in range(0, workers)])
+    for filename in os.listdir(journalPath):
+        m = re.match(r'(journal\d+)(_\d+\.spool|\.cursor)$', filename)
+        if m is not None:
+            names.add(m.group(1))
+
+    for i in sorted([int(name[7:]) for name in names]):
+        journal = replayJournal(journalPath, i, workers)
+
+        if i < workers:
+            journals.append(journal)
+        else:
+            journal.close()
+
+def replayJournal(journalPath, i, workers):
+    """ replayJournal
+    Open journal i and queue the jobs in it past what its worker
+    committed on the ring of worker i % workers, returns the journal.
+    """
+    journal = Spool(journalPath, 'journal%d' % i)
+    count   = 0
+
+    while len(journal) > 0:
+        for msg in journal.read(1):
+            jobQueues[i % workers].put(msg, prefix=_position.pack(i, *journal.position))
+            count += 1
+
+    if count > 0:
+        log.warning('replayed %d unfinished jobs from journal%d' % (count, i))
+
+    return journal
+
+def restartWorker(i, processes, workerArgs, journalPath):
+    """ restartWorker
+    Start worker i again on a new ring after it died.  What was left
+    in the old ring is replayed from the worker's journal, without
+    journals it is lost.
+    """
+    old  = processes[i]
+    left = jobQueues[i].used()
+
+    if len(journals) > 0:
+        log.error('%s died with exit code %s, restarting it and replaying its journal' % (old.name, old.exitcode))
+    else:
+        log.error('%s died with exit code %s, restarting it - %d bytes of jobs in its ring are lost' % (old.name, old.exitcode, left))
+
+    jobQueues[i]  = RingBuffer()
+    workerArgs[i] = (jobQueues[i],) + workerArgs[i][1:]
+
+    p = Process(name=old.name, target=worker, args=workerArgs[i])
+    p.start()
+    processes[i] = p
+
+    # the new worker is running so the replay can not fill its ring
+    if len(journals) > 0:
+        journals[i].close()
+        journals[i] = replayJournal(journalPath, i, len(jobQueues))
+
+def trimIndexes(db, days):
+    """ trimIndexes
+    Drop the builds, jobs and changes older than days from the time
+    indexes so they do not grow without end.
+    """
+    try:
+        removed = trimBefore(db, time.time() - days * 86400)
+    except:
+        log.error('error trimming the time indexes', exc_info=True)
+        return
+
+    if sum(removed) > 0:
+        log.info('trimmed %d builds, %d jobs and %d changes older than %g days from the time indexes' % (tuple(removed) + (days,)))
+
+def requestDrain(signum, frame):
+    """ requestDrain
+    SIGTERM handler, the main loop notices the flag between requests
+    and starts the drain.
+    """
+    global drainRequested
+    drainRequested = True
+
+def finish(processes, deadline):
+    """ finish
+    Wait until deadline for processes to exit, any still running then
+    are killed.  Returns the processes that had to be killed.
+    """
+    killed = []
+    for p in processes:
+        p.join(max(0, deadline - time.time()))
+        if p.is_alive():
+            log.error('%s did not finish draining in time, killing it' % p.name)
+            os.kill(p.pid, signal.SIGKILL)
+            p.join()
+            killed.append(p)
+
+    return killed
+
 
 _defaultOptions = { 'config':      ('-c', '--config',      None,  'Configuration file'),
                     'debug':       ('-d', '--debug',       True,  'Enable Debug', 'b'),
@@ -310,6 +814,18 @@ _defaultOptions = { 'config':      ('-c', '--config',      None,  'Configuration
                     'logpath':     ('-l', '--logpath',     None,  'Path where log file is to be written'),
                     'address':     ('',   '--address' ,    None,  'IP Address'),
                     'archivepath': ('',   '--archivepath', '.',   'Path where incoming jobs are to be archived'),
+                    'archivesync': ('',   '--archivesync', ARCHIVE_SYNC, 'Milliseconds between fsyncs of the archive, 0 to disable'),
+                    'journalpath': ('',   '--journalpath', None,  'Path where accepted jobs are journaled until a worker has written them'),
+                    'workers':     ('',   '--workers',     WORKERS,    'How many worker processes jobs are sharded across'),
+                    'batchsize':   ('',   '--batchsize',   BATCH_SIZE, 'Most jobs whose Redis writes are sent in one pipeline'),
+                    'batchtime':   ('',   '--batchtime',   BATCH_TIME, 'Milliseconds a partial Redis pipeline waits for more jobs'),
+                    'dedupe':      ('',   '--dedupe',      DEDUPE_WINDOW, "Seconds a job's message id is remembered, 0 to disable"),
+                    'startcache':  ('',   '--startcache',  START_CACHE,   'How many started jobs each worker remembers'),
+                    'startttl':    ('',   '--startttl',    START_TTL,     'Seconds a started job is remembered for'),
+                    'highwater':   ('',   '--highwater',   HIGH_WATER,    "Percentage of a worker's ring in use at which jobs are refused"),
+                    'lowwater':    ('',   '--lowwater',    LOW_WATER,     'Percentage the rings drain to before jobs are accepted again'),
+                    'draintime':   ('',   '--draintime',   DRAIN_TIME,    'Seconds the workers are given to drain after a SIGTERM'),
+                    'indexdays':   ('',   '--indexdays',   INDEX_DAYS,    'Days kept in the time indexes, 0 to keep everything'),
                     'redis':       ('-r', '--redis',      'localhost:6379', 'Redis connection string'),
                     'redisdb':     ('',   '--redisdb',    '8',              'Redis database'),
                   }
@@ -326,9 +842,115 @@ if __name__ == '__main__':
 
     db = dbRedis(options)
 
+    try:
+        batchSize = max(1, int(options.batchsize))
+    except:
+        log.error('invalid batchsize value [%s] - using default of %d' % (options.batchsize, BATCH_SIZE))
+        batchSize = BATCH_SIZE
+
+    try:
+        batchTime = float(options.batchtime)
+    except:
+        log.error('invalid batchtime value [%s] - using default of %d' % (options.batchtime, BATCH_TIME))
+        batchTime = BATCH_TIME
+
+    try:
+        workers = max(1, int(options.workers))
+    except:
+        log.error('invalid workers value [%s] - using default of %d' % (options.workers, WORKERS))
+        workers = WORKERS
+
+    try:
+        startCache = max(1, int(options.startcache))
+    except:
+        log.error('invalid startcache value [%s] - using default of %d' % (options.startcache, START_CACHE))
+        startCache = START_CACHE
+
+    try:
+        startTTL = max(1, int(options.startttl))
+    except:
+        log.error('invalid startttl value [%s] - using default of %d' % (options.startttl, START_TTL))
+        startTTL = START_TTL
+
+    try:
+        highWater = min(100, max(1, float(options.highwater))) / 100
+    except:
+        log.error('invalid highwater value [%s] - using default of %d' % (options.highwater, HIGH_WATER))
+        highWater = HIGH_WATER / 100.0
+
+    try:
+        lowWater = min(highWater * 100, max(0, float(options.lowwater))) / 100
+    except:
+        log.error('invalid lowwater value [%s] - using default of %d' % (options.lowwater, LOW_WATER))
+        lowWater = min(highWater, LOW_WATER / 100.0)
+
+    try:
+        archiveSync = max(0, float(options.archivesync))
+    except:
+        log.error('invalid archivesync value [%s] - using default of %d' % (options.archivesync, ARCHIVE_SYNC))
+        archiveSync = ARCHIVE_SYNC
+
+    try:
+        drainTime = max(0, float(options.draintime))
+    except:
+        log.error('invalid draintime value [%s] - using default of %d' % (options.draintime, DRAIN_TIME))
+        drainTime = DRAIN_TIME
+
+    try:
+        indexDays = max(0, float(options.indexdays))
+    except:
+        log.error('invalid indexdays value [%s] - using default of %d' % (options.indexdays, INDEX_DAYS))
+        indexDays = INDEX_DAYS
+
+    try:
+        dedupeWindow = max(0, int(options.dedupe))
+    except:
+        log.error('invalid dedupe value [%s] - using default of %d' % (options.dedupe, DEDUPE_WINDOW))
+        dedupeWindow = DEDUPE_WINDOW
+
+    # every worker reports metrics on the one ring
+    metricQueue = RingBuffer(producers=workers)
+
+    stopping   = Event()    # the workers drain their rings and exit
+    metricStop = Event()    # set once they have, the last metrics go out
+    results    = Queue()    # what each process flushed while draining
+    processes  = []
+    workerArgs = []
+    restarts   = [0] * workers
+
+    # the drain is run from here, a SIGTERM sent to the whole
+    # process group must not cut the workers short
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
     log.info('Creating processes')
-    Process(name='worker', target=worker, args=(jobQueue, metricQueue, db, options.archivepath)).start()
-    Process(name='metric', target=metric, args=(metricQueue, options)).start()
+    for i in range(0, workers):
+        jobQueues.append(RingBuffer())
+
+        if workers == 1:
+            name  = 'worker'
+            shard = None
+        else:
+            name  = 'worker%d' % i
+            shard = i
+
+        workerArgs.append((jobQueues[i], metricQueue, db, options.archivepath, dedupeWindow,
+                           batchSize, batchTime, shard, archiveSync,
+                           startCache, startTTL, options.journalpath,
+                           stopping, results))
+
+        p = Process(name=name, target=worker, args=workerArgs[i])
+        p.start()
+        processes.append(p)
+
+    metricProcess = Process(name='metric', target=metric, args=(metricQueue, options, metricStop, results))
+    metricProcess.start()
+
+    signal.signal(signal.SIGTERM, requestDrain)
+
+    if options.journalpath is not None:
+        if not os.path.isdir(options.journalpath):
+            os.makedirs(options.journalpath)
+        openJournals(options.journalpath, workers)
 
     if ':' not in options.address:
         options.address = '%s:%s' % (options.address, PORT_PULSE)
@@ -344,27 +966,164 @@ if __name__ == '__main__':
     log.info('Adding %s to the list of active servers' % server.identity)
     db.rpush(ID_PULSE_WORKER, server.identity)
 
+    # a drained server is marked inactive by the broker once it stops
+    # answering pings, starting again brings it back
+    db.srem('%s:inactive' % ID_PULSE_WORKER, server.identity)
+
+    poller = zmq.Poller()
+    poller.register(server, zmq.POLLIN)
+
+    busy     = False     # refusing jobs until the rings drain to lowWater
+    refused  = 0
+    draining = None      # when the SIGTERM drain started
+    trimAt   = time.time()
+
     while True:
+        # a worker that died stops emptying its ring, left alone the
+        # ring fills and every request after is answered busy
+        if draining is None:
+            for i in range(0, workers):
+                if processes[i].is_alive():
+                    continue
+                restarts[i] += 1
+                if restarts[i] > RESTARTS:
+                    log.error('%s died %d times, shutting down' % (processes[i].name, restarts[i]))
+                    drainReason    = '%s keeps dying' % processes[i].name
+                    drainRequested = True
+                    break
+                restartWorker(i, processes, workerArgs, options.journalpath)
+
+        if indexDays > 0 and draining is None and time.time() >= trimAt:
+            trimIndexes(db, indexDays)
+            trimAt = time.time() + TRIM_TIME
+
+        if drainRequested and draining is None:
+            log.warning('%s, draining %d bytes of jobs and refusing new ones' % (drainReason, sum([q.used() for q in jobQueues])))
+            log.info('Removing ourselves from the list of active servers')
+            db.lrem(ID_PULSE_WORKER, 0, server.identity)
+
+            draining = time.time()
+            refused  = 0
+            stopping.set()
+
+        # requests are still answered while the workers drain so the
+        # broker hears busy and diverts jobs instead of timing out
+        if draining is not None:
+            if time.time() >= draining + drainTime or not any([p.is_alive() for p in processes]):
+                break
+
+        try:
+            items = dict(poller.poll(POLL_TIME))
+        except:
+            log.error('error raised during poll()', exc_info=True)
+            break
+
+        if server not in items:
+            continue
+
+        # payload frames are not copied out of ZeroMQ, they go
+        # straight from the frame's memory into the worker's ring
         try:
-            request = server.recv_multipart()
+            request = server.recv_multipart(copy=False)
         except:
             log.error('error raised during recv_multipart()', exc_info=True)
             break
 
         # [ destination, sequence, control, payload ]
-        address, sequence, control = request[:3]
-        reply = [address, sequence]
+        # [ destination, sequence, 'jobs', payload, payload, ... ]
+        # [ destination, sequence, 'keyed', routing keys, payload, ... ]
+        # [ destination, sequence, 'ping', formats ]
+        address, sequence = request[:2]
+        control           = request[2].bytes
+        reply             = [address, sequence]
+
+        # the rings bound what is held in memory, the watermarks keep
+        # them from filling: above highWater the broker is told to
+        # send the jobs elsewhere until every ring is under lowWater
+        usage = max([q.usage() for q in jobQueues])
+        if draining is not None:
+            busy = True
+        elif busy and usage <= lowWater:
+            busy = False
+            log.info('workers caught up, accepting jobs again after refusing %d' % refused)
+            refused = 0
+        elif not busy and usage >= highWater:
+            busy = True
+            log.warning('workers are falling behind, rings %d%% full - refusing jobs' % (usage * 100))
 
         if control == 'ping':
             reply.append('pong')
+            if len(request) > 3:
+                offered = request[3].bytes
+                reply.append(negotiate(offered))
+                if keysOffered(offered):
+                    reply.append(WIRE_KEYS)
+        elif busy:
+            reply.append('busy')
+            if control == 'keyed':
+                refused += len(request) - 4
+            else:
+                refused += len(request) - 3
+        elif control == 'keyed':
+            reply.append('ok')
+            accept(request[4:], request[3].bytes.split('\n'))
+        elif control == 'jobs':
+            reply.append('ok')
+            accept(request[3:])
         else:
             reply.append('ok')
-            jobQueue.put(request[3])
+            accept(request[3:4])
 
         server.send_multipart(reply)
 
-    log.info('Removing ourselves to the list of active servers')
-    db.lrem(ID_PULSE_WORKER, 0, server.identity)
+        for journal in journals:
+            journal.sync()
+
+    server.close()
+
+    if draining is None:
+        log.info('Removing ourselves from the list of active servers')
+        db.lrem(ID_PULSE_WORKER, 0, server.identity)
+
+        draining = time.time()
+        stopping.set()
+
+    deadline = draining + drainTime
+    killed   = finish(processes, deadline)
+
+    # the workers' last metrics are in the ring now, they are given
+    # at least a second to go out even if the workers ran late
+    metricStop.set()
+    killed += finish([metricProcess], max(deadline, time.time() + 1))
+
+    for journal in journals:
+        journal.close()
+
+    log.info('drain finished in %0.2fs, %d jobs refused meanwhile' % (time.time() - draining, refused))
+
+    while True:
+        try:
+            result = results.get(False)
+        except Empty:
+            break
+
+        if result[0] == 'metric':
+            log.info('%s: %d metrics sent, %d bytes left unsent' % result)
+        else:
+            log.info('%s: %d jobs written to Redis in %d pipelines' % result)
+
+    for p in killed:
+        if p in processes:
+            left = jobQueues[processes.index(p)].used()
+            if len(journals) > 0:
+                log.error('%s: killed with %d bytes of jobs in its ring, they are replayed from its journal on the next start' % (p.name, left))
+            else:
+                log.error('%s: killed with %d bytes of jobs in its ring, they are lost' % (p.name, left))
+        else:
+            log.error('%s: killed with %d bytes of metrics unsent' % (p.name, metricQueue.used()))
 
     log.info('done')
 
+    if max(restarts) > RESTARTS:
+        sys.exit(1)
+
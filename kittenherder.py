@@ -101,9 +101,8 @@ def previouslySeen(hostlist, lastrun):
 
 def getHistory(kitten):
     result = ''
-    keys   = db.keys('kittenherder:*:%s' % kitten)
-    for key in keys:
-        d = db.hgetall(key)
+    keys   = list(db.iterkeys('kittenherder:*:%s' % kitten))
+    for key, d in zip(keys, db.hgetallBatch(keys)):
         result += '    %s ' % key.replace('kittenherder:', '').replace(':%s' % kitten, '')
 
         for f in ('reachable', 'reboot', 'recovery', 'lastseen'):
@@ -126,13 +125,17 @@ def sendEmail(data):
         neither      = []
         body         = ''
 
-        lastRun = db.lrange('kittenherder:lastrun', 0, -1)
-        db.ltrim('kittenherder:lastrun', 0, 0)
-        db.expire('kittenherder:lastrun', keyExpire)
+        with db.transaction() as t:
+            t.lrange('kittenherder:lastrun', 0, -1)
+            t.ltrim('kittenherder:lastrun', 0, 0)
+            t.expire('kittenherder:lastrun', keyExpire)
+        lastRun = t.results[0]
+
+        pipe = db.pipeline()
 
         print lastRun
         for kitten, result in data:
-            db.lpush('kittenherder:lastrun', kitten)
+            pipe.lpush('kittenherder:lastrun', kitten)
 
             print len(result), kitten, result
             if len(result) > 0:
@@ -150,6 +153,8 @@ def sendEmail(data):
                         if not result['reachable']:
                             neither.append(kitten)
 
+        pipe.execute()
+
         if len(rebootedOS) > 0:
             prevSeen = previouslySeen(rebootedOS, lastRun)
             body += generate(rebootedOS, 'rebooted (SSH)')
@@ -224,9 +229,9 @@ def processKittens(options, jobs, results):
                         r['output'] += d['output']
 
                         hostKey = 'kittenherder:%s.%s:%s' % (dDate, dHour, job)
-                        for key in r:
-                            db.hset(hostKey, key, r[key])
-                        db.expire(hostKey, keyExpire)
+                        with db.pipeline() as pipe:
+                            pipe.hmset(hostKey, r)
+                            pipe.expire(hostKey, keyExpire)
 
                         print job, r
                 else:
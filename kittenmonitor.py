@@ -39,9 +39,10 @@ import smtplib
 import email.utils
 
 from email.mime.text import MIMEText
-from datetime import date, datetime, timedelta
 
 from releng import initOptions, initLogs, dbRedis
+from releng.isotime import timeBucket
+from releng.timeindex import jobsBetween, bucketRange
 
 log = logging.getLogger()
 
@@ -115,7 +116,7 @@ def gatherData(db, dToday, dHour):
     jobs      = {}
     platforms = {}
 
-    print 'build:%s.%s' % (dToday, dHour)
+    print 'jobs for %s %s:00' % (dToday, dHour)
 
     dashboard['jobs']              = 0
     dashboard['jobsBuild']         = 0
@@ -135,9 +136,10 @@ def gatherData(db, dToday, dHour):
     dashboard['maxElapsedKitten']  = ''
     dashboard['maxElapsedJobKey']  = ''
 
-    for key in db.smembers('build:%s.%s' % (dToday, dHour)):
-        for jobKey in db.smembers(key):
-            build    = db.hgetall(jobKey)
+    jobKeys = jobsBetween(db, *bucketRange(dToday, dHour))
+
+    if len(jobKeys) > 0:
+        for jobKey, build in zip(jobKeys, db.hgetallBatch(jobKeys)):
             builduid = build['builduid']
             kitten   = build['slave']
 
@@ -247,14 +249,16 @@ def gatherData(db, dToday, dHour):
         else:
             dashboard['meanElapsed'] = 0
 
-    if dashboard['jobs'] > 0:
-        for key in dashboard:
-            db.hset(dKey, key, dashboard[key])
-
-    dKeyQC = 'dashboard:queue_collapses:%s.%s' % (dToday, dHour)
+    dKeyQC    = 'dashboard:queue_collapses:%s.%s' % (dToday, dHour)
+    collapses = {}
     for key in platforms:
-        db.hset(dKeyQC, key.lower(), platforms[key])
-    db.hset(dKeyQC, 'total', dashboard['collapses'])
+        collapses[key.lower()] = platforms[key]
+    collapses['total'] = dashboard['collapses']
+
+    with db.pipeline() as pipe:
+        if dashboard['jobs'] > 0:
+            pipe.hmset(dKey, dashboard)
+        pipe.hmset(dKeyQC, collapses)
 
     return alerts
 
@@ -299,13 +303,13 @@ if __name__ == '__main__':
 
     db = dbRedis(options)
 
-    tdHour  = timedelta(hours=-1)
-    dGather = datetime.now()
+    tGather = time.time()
 
     # gatherData(db, '2012-03-15', '02')
     for i in range(0, 3):
-        alerts  = gatherData(db, dGather.strftime('%Y-%m-%d'), dGather.strftime('%H'))
-        dGather = dGather + tdHour
+        dGather, hGather = timeBucket(tGather)
+        alerts           = gatherData(db, dGather, hGather)
+        tGather         -= 3600
 
         if i == 0 and len(alerts) > 0 and options.email:
             sendAlertEmail(alerts, options)
@@ -65,89 +65,303 @@ def relative(delta):
     else:
         return '%d hours ago' % (delta.seconds / 3600)
 
-class dbRedis(object):
-    def __init__(self, options):
-        if ':' in options.redis:
-            host, port = options.redis.split(':')
-            try:
-                port = int(port)
-            except:
-                port = 6379
-        else:
-            host = options.redis
-            port = 6379
+def _isOne(value):
+    return value == 1
 
-        try:
-            db = int(options.redisdb)
-        except:
-            db = 8
-
-        log.info('dbRedis %s:%s db=%d' % (host, port, db))
-
-        self.host   = host
-        self.db     = db
-        self.port   = port
-        self._redis = redis.StrictRedis(host=host, port=port, db=db)
-
-    def ping(self):
-        return self._redis.ping()
+class dbCommands(object):
+    """The Redis commands the tools use.
 
+    Mixed into dbRedis, which runs each one right away, and dbPipeline,
+    which queues them.  Both define _command(convert, name, *args),
+    the commands here are only ever called through one of them.
+    """
     def exists(self, key):
-        return self._redis.exists(key)
+        return self._command(None, 'exists', key)
 
     def keys(self, search):
-        return self._redis.keys(search)
+        return self._command(None, 'keys', search)
 
     def expire(self, key, seconds=86400):
-        return self._redis.expire(key, seconds)
+        return self._command(None, 'expire', key, seconds)
+
+    def delete(self, key):
+        return self._command(None, 'delete', key)
 
     def lrange(self, listName, start, end):
-        return self._redis.lrange(listName, start, end)
+        return self._command(None, 'lrange', listName, start, end)
 
     def ltrim(self, listName, start, end):
-        return self._redis.ltrim(listName, start, end)
+        return self._command(None, 'ltrim', listName, start, end)
 
     def lrem(self, listName, count, item):
-        return self._redis.lrem(listName, count, item)
+        return self._command(None, 'lrem', listName, count, item)
 
-    def lpush(self, listName, item):
-        return self._redis.lpush(listName, item)
+    def lpush(self, listName, *items):
+        return self._command(None, 'lpush', listName, *items)
 
     def rpush(self, listName, item):
-        return self._redis.rpush(listName, item)
+        return self._command(None, 'rpush', listName, item)
 
-    def sadd(self, setName, item):
-        return self._redis.sadd(setName, item)
+    def sadd(self, setName, *items):
+        return self._command(None, 'sadd', setName, *items)
 
     def srem(self, setName, item):
-        return self._redis.sadd(setName, item)
+        return self._command(None, 'srem', setName, item)
 
     def smembers(self, setName):
-        return self._redis.smembers(setName)
+        return self._command(None, 'smembers', setName)
 
     def sismember(self, setName, item):
-        return self._redis.sismember(setName, item) == 1
+        return self._command(_isOne, 'sismember', setName, item)
 
     def set(self, key, value, expires=None):
         if expires is None:
-            return self._redis.set(key, value)
+            return self._command(None, 'set', key, value)
         else:
-            return self._redis.setex(key, expires, value)
+            return self._command(None, 'setex', key, expires, value)
 
     def incr(self, key):
-        return self._redis.incr(key)
+        return self._command(None, 'incr', key)
 
     def hincrby(self, key, field, increment=1):
-        return self._redis.hincrby(key, field, increment)
+        return self._command(None, 'hincrby', key, field, increment)
 
     def hset(self, key, field, value):
-        return self._redis.hset(key, field, value)
+        return self._command(None, 'hset', key, field, value)
+
+    def hmset(self, key, mapping):
+        """Set every field of mapping on hash key in one command."""
+        return self._command(None, 'hmset', key, mapping)
 
     def hget(self, key, field):
-        return self._redis.hget(key, field)
+        return self._command(None, 'hget', key, field)
 
     def hgetall(self, key):
-        return self._redis.hgetall(key)
+        return self._command(None, 'hgetall', key)
+
+    def zadd(self, key, mapping):
+        """Add each member of mapping to sorted set key with its score."""
+        args = []
+        for member in mapping:
+            args += [mapping[member], member]
+        return self._command(None, 'zadd', key, *args)
+
+    def zrangebyscore(self, key, low, high, offset=None, count=None):
+        return self._command(None, 'zrangebyscore', key, low, high, offset, count)
+
+    def zscore(self, key, member):
+        return self._command(None, 'zscore', key, member)
+
+    def zcount(self, key, low, high):
+        return self._command(None, 'zcount', key, low, high)
+
+    def zremrangebyscore(self, key, low, high):
+        return self._command(None, 'zremrangebyscore', key, low, high)
+
+class dbPipeline(dbCommands):
+    """Queue dbRedis commands and send them in one round trip.
+
+    Each wrapper method queues its command, execute() sends them all
+    and returns their results in order, also kept in .results.  Used
+    as a context manager the commands are sent on a clean exit and
+    thrown away if an exception is raised.
+
+        with db.pipeline() as pipe:
+            pipe.hset(jobKey, 'slave', slave)
+            pipe.hgetall(buildKey)
+        build = pipe.results[-1]
+    """
+    def __init__(self, pipe):
+        self._pipe      = pipe
+        self._converts  = []
+        self.results    = None
+
+    def __len__(self):
+        return len(self._converts)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        if excType is None:
+            self.execute()
+        else:
+            self.reset()
+        return False
+
+    def _command(self, convert, name, *args, **kwargs):
+        getattr(self._pipe, name)(*args, **kwargs)
+        self._converts.append(convert)
+        return self
+
+    def execute(self):
+        results = self._pipe.execute()
+        for i in range(0, len(results)):
+            if self._converts[i] is not None:
+                results[i] = self._converts[i](results[i])
+
+        self._converts = []
+        self.results   = results
+
+        return results
+
+    def reset(self):
+        self._pipe.reset()
+        self._converts = []
+
+class dbBatch(object):
+    """Coalesce the Redis writes of many jobs before they are queued
+    on a dbPipeline.
+
+    Takes the hmset, sadd, zadd, lpush and ltrim commands of dbCommands
+    so it can be handed to code that writes to a pipeline.  Fields set
+    on the same hash become one HMSET, members added to the same set or
+    sorted set one SADD or ZADD, the last score given a member winning,
+    and items pushed on the same list one LPUSH followed by the last
+    LTRIM of that list.  The result is the same as sending each
+    command on its own as long as a key is only written by one kind of
+    command and trims keep the head of their list.
+
+        batch = dbBatch()
+        batch.sadd('build:2012-03-14', buildKey)
+        ...
+        batch.apply(pipe)
+        pipe.execute()
+    """
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.count  = 0     # commands written to the batch
+        self.hashes = {}
+        self.sets   = {}
+        self.zsets  = {}
+        self.lists  = {}
+        self.trims  = {}
+
+    def hmset(self, key, mapping):
+        if key in self.hashes:
+            self.hashes[key].update(mapping)
+        else:
+            self.hashes[key] = dict(mapping)
+        self.count += 1
+
+    def sadd(self, setName, *items):
+        if setName in self.sets:
+            self.sets[setName].update(items)
+        else:
+            self.sets[setName] = set(items)
+        self.count += 1
+
+    def zadd(self, key, mapping):
+        if key in self.zsets:
+            self.zsets[key].update(mapping)
+        else:
+            self.zsets[key] = dict(mapping)
+        self.count += 1
+
+    def lpush(self, listName, *items):
+        if listName in self.lists:
+            self.lists[listName].extend(items)
+        else:
+            self.lists[listName] = list(items)
+        self.count += 1
+
+    def ltrim(self, listName, start, end):
+        self.trims[listName] = (start, end)
+        self.count += 1
+
+    def apply(self, pipe, clear=True):
+        """Queue the coalesced commands on pipe and empty the batch
+        unless clear is False, returns how many commands were queued.
+        """
+        for key in self.hashes:
+            pipe.hmset(key, self.hashes[key])
+        for key in self.sets:
+            pipe.sadd(key, *self.sets[key])
+        for key in self.zsets:
+            pipe.zadd(key, self.zsets[key])
+        for key in self.lists:
+            pipe.lpush(key, *self.lists[key])
+        for key in self.trims:
+            pipe.ltrim(key, *self.trims[key])
+
+        result = len(self.hashes) + len(self.sets) + len(self.zsets) + len(self.lists) + len(self.trims)
+
+        if clear:
+            self.clear()
+
+        return result
+
+class dbRedis(dbCommands):
+    def __init__(self, options):
+        if ':' in options.redis:
+            host, port = options.redis.split(':')
+            try:
+                port = int(port)
+            except:
+                port = 6379
+        else:
+            host = options.redis
+            port = 6379
+
+        try:
+            db = int(options.redisdb)
+        except:
+            db = 8
+
+        log.info('dbRedis %s:%s db=%d' % (host, port, db))
+
+        self.host   = host
+        self.db     = db
+        self.port   = port
+        self._redis = redis.StrictRedis(host=host, port=port, db=db)
+
+    def _command(self, convert, name, *args, **kwargs):
+        result = getattr(self._redis, name)(*args, **kwargs)
+        if convert is not None:
+            result = convert(result)
+        return result
+
+    def ping(self):
+        return self._redis.ping()
+
+    def pipeline(self):
+        """Return a dbPipeline, commands queued on it are sent
+        in one round trip by its execute().
+        """
+        return dbPipeline(self._redis.pipeline(transaction=False))
+
+    def transaction(self):
+        """Return a dbPipeline whose commands run as a single
+        MULTI/EXEC transaction.
+        """
+        return dbPipeline(self._redis.pipeline(transaction=True))
+
+    def iterkeys(self, search, count=1000):
+        """Generate the keys matching search using SCAN, count
+        keys at a time, so a large keyspace does not block Redis
+        the way keys() does.
+        """
+        return self._redis.scan_iter(match=search, count=count)
+
+    def hgetallBatch(self, keys):
+        """Return the hgetall() of each of keys, in one round trip."""
+        pipe = self.pipeline()
+        for key in keys:
+            pipe.hgetall(key)
+        return pipe.execute()
+
+    def hmsetBatch(self, items):
+        """hmset() each (key, mapping) in items, in one round trip."""
+        pipe = self.pipeline()
+        for key, mapping in items:
+            if len(mapping) > 0:
+                pipe.hmset(key, mapping)
+        return pipe.execute()
 
 def loadConfig(filename):
     result = {}
@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" releng - archive
+
+    daily archive files of the jobs bpServer has handled
+
+    :copyright: (c) 2012 by Mozilla
+    :license: MPLv2
+
+    Assumes Python v2.6+
+
+    An archive is a pair of files per UTC day (and worker shard)
+
+        bp_archive_YYYYMMDD.blk     zlib compressed blocks of jobs
+        bp_archive_YYYYMMDD.idx     one json line per block
+
+    Each block is stored as [length, crc32, data] and holds up to
+    BLOCK_SIZE bytes of "<epoch> <job json>" lines, epoch being when
+    bpServer received the job.  Its index line gives the offset and
+    length of the block, how many jobs it holds, the first and last
+    epoch in it and the slaves and builduids of those jobs:
+
+        {"offset": 0, "length": 9135, "count": 120,
+         "first": 1331683200.1, "last": 1331683207.9,
+         "slaves": [...], "builduids": [...]}
+
+    A block is only listed once it is completely written, a crash
+    loses at most the block being filled.  Reopening an archive after
+    a crash truncates both files back to the last indexed block.
+
+    ArchiveReader loads the index, turns the slave and builduid lists
+    into an inverted index and only reads the blocks a query can
+    match.  If the .idx file is missing it is rebuilt by walking the
+    blocks.
+
+    Older plain json-lines .dat archives are read as well, they are
+    simply scanned.
+
+    Authors:
+        bear    Mike Taylor <bear@mozilla.com>
+"""
+
+import os
+import json
+import time
+import zlib
+import struct
+import threading
+
+from Queue import Queue, Empty
+from multiprocessing import get_logger
+
+from releng.wire import isJSON, decodeJob, jobBuilduid
+
+
+log = get_logger()
+
+BLOCK_SIZE     = 64 * 1024      # bytes of jobs compressed together
+ARCHIVE_FLUSH  = 1              # seconds a partial block waits before being written
+ARCHIVE_SYNC   = 0              # seconds between fsyncs, 0 to leave it to the OS
+
+_header = struct.Struct('>II')  # compressed length, crc32 of the compressed data
+
+
+def archiveName(stamp, shard=None):
+    """Base name of the archive files for the UTC day stamp falls in."""
+    day = time.strftime('%Y%m%d', time.gmtime(stamp))
+    if shard is None:
+        return 'bp_archive_%s' % day
+    else:
+        return 'bp_archive_%s.%d' % (day, shard)
+
+
+class ArchiveWriter(threading.Thread):
+    """Background thread appending jobs to the day's archive.
+
+    write() only queues the job with the time it was handed over, so
+    the caller never waits on the disk.  The thread collects jobs into
+    a block which is compressed and written once it holds BLOCK_SIZE
+    bytes or flushInterval seconds after its first job, and moves to
+    the next day's files as soon as a job stamped after UTC midnight
+    comes in, or at midnight itself if things are quiet.
+
+    With syncInterval set the files are also fsync'd, at most once
+    every syncInterval seconds, so a burst of blocks shares an fsync.
+
+        archive = ArchiveWriter('/var/log/briarpatch')
+        archive.start()
+        archive.write(msg)
+        ...
+        archive.close()
+    """
+    def __init__(self, path, shard=None, syncInterval=ARCHIVE_SYNC, flushInterval=ARCHIVE_FLUSH, blockSize=BLOCK_SIZE):
+        threading.Thread.__init__(self, name='archive')
+
+        self.daemon        = True
+        self.path          = path
+        self.shard         = shard
+        self.syncInterval  = syncInterval
+        self.flushInterval = flushInterval
+        self.blockSize     = blockSize
+        self.queue         = Queue()
+        self.blocks        = None
+        self.index         = None
+        self.filename      = None
+        self.offset        = 0
+        self.rotateAt      = 0
+        self.lastSync      = time.time()
+        self.unsynced      = 0
+        self.count         = 0
+        self.reset()
+
+        if syncInterval > 0:
+            self.wait = min(flushInterval, syncInterval)
+        else:
+            self.wait = flushInterval
+
+    def reset(self):
+        self.lines     = []
+        self.size      = 0
+        self.first     = None
+        self.last      = None
+        self.slaves    = set()
+        self.builduids = set()
+        self.started   = None
+
+    def write(self, entry):
+        self.queue.put((time.time(), entry))
+
+    def close(self, timeout=None):
+        """Archive everything queued so far and stop the thread."""
+        self.queue.put(None)
+        self.join(timeout)
+
+    def open(self, stamp):
+        self.closeFiles()
+
+        self.filename = os.path.join(self.path, archiveName(stamp, self.shard))
+        self.recover()
+        self.blocks   = open('%s.blk' % self.filename, 'ab')
+        self.index    = open('%s.idx' % self.filename, 'ab')
+        self.rotateAt = (int(stamp) // 86400 + 1) * 86400
+
+        self.blocks.seek(0, 2)
+        self.offset = self.blocks.tell()
+
+        log.info('archiving to %s.blk' % self.filename)
+
+    def recover(self):
+        """Truncate the files of an archive being reopened after a crash
+        to the last block that was completely written and indexed, and
+        the index to its last complete line, so blocks and index lines
+        written from now on do not land behind a torn one.  A missing
+        index is rebuilt from the blocks first.
+        """
+        blockFile = '%s.blk' % self.filename
+        indexFile = '%s.idx' % self.filename
+
+        if os.path.isfile(blockFile):
+            size = os.path.getsize(blockFile)
+        else:
+            size = 0
+
+        if size > 0 and not os.path.isfile(indexFile):
+            entries = ArchiveReader(self.filename).index
+            h       = open(indexFile, 'wb')
+            for entry in entries:
+                h.write('%s\n' % json.dumps(entry))
+            h.close()
+
+        good = 0
+        if os.path.isfile(indexFile):
+            h   = open(indexFile, 'r+b')
+            end = 0
+
+            while True:
+                line = h.readline()
+                if not line.endswith('\n'):
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if entry['offset'] != good or good + entry['length'] > size:
+                    break
+
+                good = entry['offset'] + entry['length']
+                end  = h.tell()
+
+            h.seek(0, 2)
+            if h.tell() > end:
+                log.warning('%s truncated to %d bytes, %d bytes were torn or corrupt' % (indexFile, end, h.tell() - end))
+                h.truncate(end)
+            h.close()
+
+        if size > good:
+            log.warning('%s truncated to %d bytes, %d bytes were torn or not indexed' % (blockFile, good, size - good))
+            h = open(blockFile, 'r+b')
+            h.truncate(good)
+            h.close()
+
+    def closeFiles(self):
+        if self.blocks is not None:
+            self.flush(force=True)
+            self.blocks.close()
+            self.index.close()
+            self.blocks = None
+            self.index  = None
+
+    def add(self, stamp, entry):
+        job = decodeJob(entry)
+        if not isJSON(entry):
+            entry = json.dumps(job)
+
+        line = '%r %s' % (stamp, entry)
+
+        self.lines.append(line)
+        self.size += len(line) + 1
+        self.last  = stamp
+        if self.first is None:
+            self.first   = stamp
+            self.started = time.time()
+
+        slave    = job.get('slave')
+        builduid = jobBuilduid(job)
+        if slave is not None:
+            self.slaves.add(slave)
+        if builduid is not None:
+            self.builduids.add(builduid)
+
+        self.count += 1
+
+    def flush(self, force=False):
+        """Write out the block being filled if it is full, if it has
+        waited flushInterval seconds or if force is set.
+        """
+        now = time.time()
+
+        if len(self.lines) > 0 and (force or self.size >= self.blockSize or now - self.started >= self.flushInterval):
+            data = zlib.compress('\n'.join(self.lines))
+
+            self.blocks.write(_header.pack(len(data), zlib.crc32(data) & 0xffffffff))
+            self.blocks.write(data)
+            self.blocks.flush()
+
+            entry = { 'offset':    self.offset,
+                      'length':    _header.size + len(data),
+                      'count':     len(self.lines),
+                      'first':     self.first,
+                      'last':      self.last,
+                      'slaves':    sorted(self.slaves),
+                      'builduids': sorted(self.builduids),
+                    }
+            self.index.write('%s\n' % json.dumps(entry))
+            self.index.flush()
+
+            self.offset   += entry['length']
+            self.unsynced += 1
+            self.reset()
+
+        if self.syncInterval > 0 and self.unsynced > 0 and (force or now - self.lastSync >= self.syncInterval):
+            os.fsync(self.blocks.fileno())
+            os.fsync(self.index.fileno())
+            self.unsynced = 0
+            self.lastSync = now
+
+    def run(self):
+        log.info('archive writer starting')
+
+        while True:
+            try:
+                item = self.queue.get(True, self.wait)
+            except Empty:
+                item = ()
+
+            if item is None:
+                break
+
+            if len(item) > 0:
+                stamp, entry = item
+
+                if self.blocks is None or stamp >= self.rotateAt:
+                    self.open(stamp)
+
+                try:
+                    self.add(stamp, entry)
+                except:
+                    log.error('unable to archive job to %s' % self.filename, exc_info=True)
+
+            elif self.blocks is not None and time.time() >= self.rotateAt:
+                self.closeFiles()
+
+            if self.blocks is not None:
+                try:
+                    self.flush()
+                except:
+                    log.error('unable to write archive block to %s' % self.filename, exc_info=True)
+                    self.reset()
+
+        self.closeFiles()
+
+        log.info('archive writer done, %d jobs archived' % self.count)
+
+
+class ArchiveReader(object):
+    """Query one archive written by ArchiveWriter, or an older plain
+    json-lines one.  filename can be given with or without the .blk
+    or .idx extension.
+
+        reader = ArchiveReader('/var/log/briarpatch/bp_archive_20120314')
+        for stamp, job in reader.records(builduid='...'):
+            ...
+
+    start and end are epochs and select the jobs received in that
+    range, either can be left out.  records() yields the json of each
+    job as it was archived, jobs() the decoded job.  Plain archives
+    have no receive times, their stamps are None and start/end are
+    ignored.
+    """
+    def __init__(self, filename):
+        base, ext = os.path.splitext(filename)
+
+        if ext in ('.blk', '.idx'):
+            filename = base
+
+        if os.path.isfile('%s.blk' % filename):
+            self.filename = '%s.blk' % filename
+            self.plain    = False
+            self.loadIndex('%s.idx' % filename)
+        else:
+            self.filename = filename
+            self.plain    = True
+            self.index    = []
+
+    def loadIndex(self, indexFile):
+        self.index     = []
+        self.slaves    = {}
+        self.builduids = {}
+
+        if os.path.isfile(indexFile):
+            for line in open(indexFile, 'r'):
+                try:
+                    self.index.append(json.loads(line))
+                except ValueError:
+                    log.warning('skipping unreadable index entry in %s' % indexFile)
+        else:
+            log.warning('%s not found, rebuilding it from %s' % (indexFile, self.filename))
+            self.index = self.scan()
+
+        for n, entry in enumerate(self.index):
+            for slave in entry['slaves']:
+                self.slaves.setdefault(slave, []).append(n)
+            for builduid in entry['builduids']:
+                self.builduids.setdefault(builduid, []).append(n)
+
+    def scan(self):
+        """Walk the blocks file and build the index entries from it."""
+        result = []
+        h      = open(self.filename, 'rb')
+
+        while True:
+            offset = h.tell()
+            lines  = self.readBlock(h)
+            if lines is None:
+                break
+
+            stamps    = []
+            slaves    = set()
+            builduids = set()
+            for line in lines:
+                stamp, entry = line.split(' ', 1)
+                job          = json.loads(entry)
+                stamps.append(float(stamp))
+                if job.get('slave') is not None:
+                    slaves.add(job['slave'])
+                if jobBuilduid(job) is not None:
+                    builduids.add(jobBuilduid(job))
+
+            result.append({ 'offset':    offset,
+                            'length':    h.tell() - offset,
+                            'count':     len(lines),
+                            'first':     min(stamps),
+                            'last':      max(stamps),
+                            'slaves':    sorted(slaves),
+                            'builduids': sorted(builduids),
+                          })
+        h.close()
+
+        return result
+
+    def readBlock(self, h):
+        header = h.read(_header.size)
+        if len(header) < _header.size:
+            return None
+
+        length, crc = _header.unpack(header)
+        data        = h.read(length)
+
+        if len(data) < length or (zlib.crc32(data) & 0xffffffff) != crc:
+            return None
+
+        return zlib.decompress(data).split('\n')
+
+    def __len__(self):
+        return sum([entry['count'] for entry in self.index])
+
+    def blocks(self, start=None, end=None, slave=None, builduid=None):
+        """Index entries of the blocks that can hold matching jobs."""
+        if slave is None and builduid is None:
+            candidates = range(0, len(self.index))
+        else:
+            candidates = None
+            for keys, value in ((self.slaves, slave), (self.builduids, builduid)):
+                if value is not None:
+                    found = set(keys.get(value, []))
+                    if candidates is None:
+                        candidates = found
+                    else:
+                        candidates &= found
+            candidates = sorted(candidates)
+
+        result = []
+        for n in candidates:
+            entry = self.index[n]
+            if start is not None and entry['last'] < start:
+                continue
+            if end is not None and entry['first'] > end:
+                continue
+            result.append(entry)
+
+        return result
+
+    def records(self, start=None, end=None, slave=None, builduid=None):
+        """Generate (stamp, json) for each matching job."""
+        if self.plain:
+            for stamp, entry, job in self.scanPlain(slave, builduid):
+                yield stamp, entry
+            return
+
+        h = open(self.filename, 'rb')
+
+        for block in self.blocks(start, end, slave, builduid):
+            h.seek(block['offset'])
+            lines = self.readBlock(h)
+            if lines is None:
+                log.warning('block at %d of %s is damaged, skipping it' % (block['offset'], self.filename))
+                continue
+
+            for line in lines:
+                stamp, entry = line.split(' ', 1)
+                stamp        = float(stamp)
+
+                if start is not None and stamp < start:
+                    continue
+                if end is not None and stamp > end:
+                    continue
+                if slave is not None or builduid is not None:
+                    job = json.loads(entry)
+                    if slave is not None and job.get('slave') != slave:
+                        continue
+                    if builduid is not None and jobBuilduid(job) != builduid:
+                        continue
+
+                yield stamp, entry
+
+        h.close()
+
+    def scanPlain(self, slave=None, builduid=None):
+        for line in open(self.filename, 'r'):
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError:
+                log.warning('skipping unreadable archive entry [%s]' % line[:42])
+                continue
+
+            if slave is not None and job.get('slave') != slave:
+                continue
+            if builduid is not None and jobBuilduid(job) != builduid:
+                continue
+
+            yield None, line, job
+
+    def jobs(self, start=None, end=None, slave=None, builduid=None):
+        """Generate each matching job, decoded."""
+        for stamp, entry in self.records(start, end, slave, builduid):
+            yield json.loads(entry)
+
+
+def readArchive(filenames, start=None, end=None, slave=None, builduid=None):
+    """Generate the matching jobs of each archive in turn, filenames
+    is a list or a comma separated string.
+    """
+    if isinstance(filenames, basestring):
+        filenames = filenames.split(',')
+
+    for filename in filenames:
+        for job in ArchiveReader(filename).jobs(start, end, slave, builduid):
+            yield job
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" releng - cache
+
+    small fixed size in-memory caches
+
+    :copyright: (c) 2012 by Mozilla
+    :license: MPLv2
+
+    Assumes Python v2.6+
+
+    Authors:
+        bear    Mike Taylor <bear@mozilla.com>
+"""
+
+import time
+
+
+# fields of a list entry, an entry is [prev, next, key, value]
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+
+class LRUCache(object):
+    """Mapping that holds at most size items, dropping the least
+    recently used one to make room for a new one.  A size of 0 keeps
+    nothing.
+
+        cache = LRUCache(1000)
+        cache.put('job:1234', data)
+        cache.get('job:1234')       # data, and now the most recent item
+
+    Items are kept in a dict of entries that are also linked into a
+    circular list, least recently used first, so every operation is
+    O(1) without needing OrderedDict.
+    """
+    def __init__(self, size=1000):
+        self.size  = size
+        self.items = {}
+        self.root  = []     # sentinel entry the list starts and ends at
+        self.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        """Membership test, does not count as a use of key."""
+        return key in self.items
+
+    def _unlink(self, entry):
+        entry[PREV][NEXT] = entry[NEXT]
+        entry[NEXT][PREV] = entry[PREV]
+
+    def _append(self, entry):
+        root        = self.root
+        last        = root[PREV]
+        entry[PREV] = last
+        entry[NEXT] = root
+        last[NEXT]  = entry
+        root[PREV]  = entry
+
+    def get(self, key, default=None):
+        entry = self.items.get(key)
+        if entry is None:
+            return default
+
+        self._unlink(entry)
+        self._append(entry)
+
+        return entry[VALUE]
+
+    def put(self, key, value):
+        if self.size < 1:
+            return
+
+        entry = self.items.get(key)
+        if entry is not None:
+            self._unlink(entry)
+        elif len(self.items) >= self.size:
+            oldest = self.root[NEXT]
+            self._unlink(oldest)
+            del self.items[oldest[KEY]]
+
+        entry = [None, None, key, value]
+        self._append(entry)
+        self.items[key] = entry
+
+    def pop(self, key, default=None):
+        entry = self.items.pop(key, None)
+        if entry is None:
+            return default
+
+        self._unlink(entry)
+
+        return entry[VALUE]
+
+    def clear(self):
+        self.items.clear()
+        self.root[:] = [self.root, self.root, None, None]
+
+
+class TTLCache(LRUCache):
+    """LRUCache whose items are also forgotten ttl seconds after they
+    were put.  Expired items are dropped as they are found.
+
+        cache = TTLCache(1000, 3600)
+        cache.put('job:1234', data)
+        cache.get('job:1234')       # data for the next hour
+    """
+    def __init__(self, size=1000, ttl=3600):
+        LRUCache.__init__(self, size)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        item = LRUCache.get(self, key)
+        if item is None:
+            return default
+
+        stamp, value = item
+        if time.time() - stamp > self.ttl:
+            LRUCache.pop(self, key)
+            return default
+
+        return value
+
+    def put(self, key, value):
+        LRUCache.put(self, key, (time.time(), value))
+
+    def pop(self, key, default=None):
+        item = LRUCache.pop(self, key)
+        if item is None or time.time() - item[0] > self.ttl:
+            return default
+        return item[1]
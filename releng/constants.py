@@ -29,3 +29,15 @@ METRICS_HASH  = 'h'
 METRICS_KEY   = 'k'
 METRICS_LIST  = 'l'
 METRICS_SET   = 's'
+METRICS_TIMER = 't'
+
+# sorted sets of build:, job: and change: keys scored by epoch
+INDEX_BUILD  = 'index:build'
+INDEX_JOB    = 'index:job'
+INDEX_CHANGE = 'index:change'
+
+# build and change properties the job servers read from Pulse messages
+PULSE_PROPERTIES = ('branch', 'product', 'platform', 'revision', 'request_ids',
+                    'builduid', 'buildnumber', 'buildid', 'statusdb_id',
+                    'build_url', 'log_url', 'pgo_build', 'scheduler', 'who',
+                   )
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" releng - dedupe
+
+    spot messages that have already been seen recently
+
+    :copyright: (c) 2012 by Mozilla
+    :license: MPLv2
+
+    Assumes Python v2.6+
+
+    Authors:
+        bear    Mike Taylor <bear@mozilla.com>
+"""
+
+import math
+import time
+import struct
+import hashlib
+
+from multiprocessing import get_logger
+
+from releng.cache import LRUCache
+
+
+log = get_logger()
+
+DEDUPE_WINDOW     = 900      # seconds a message id is remembered for
+DEDUPE_SLICES     = 4        # bloom filters the window is split across
+DEDUPE_CAPACITY   = 50000    # ids each slice holds before its error rate climbs
+DEDUPE_RECENT     = 10000    # ids kept exactly in the LRU
+DEDUPE_ERROR_RATE = 0.00001  # false positive rate of a slice at capacity
+
+
+class BloomFilter(object):
+    """Fixed size bloom filter sized for capacity keys at errorRate.
+
+    The k bit positions come from a single md5 using double hashing.
+    """
+    def __init__(self, capacity, errorRate):
+        self.capacity = capacity
+        self.size     = int(math.ceil(-capacity * math.log(errorRate) / (math.log(2) ** 2)))
+        self.hashes   = max(1, int(round(math.log(2) * self.size / capacity)))
+        self.bits     = bytearray((self.size + 7) // 8)
+        self.count    = 0
+
+    def positions(self, key):
+        h1, h2 = struct.unpack('>QQ', hashlib.md5(key).digest())
+        for i in range(0, self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key):
+        for n in self.positions(key):
+            self.bits[n >> 3] |= 1 << (n & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for n in self.positions(key):
+            if not self.bits[n >> 3] & (1 << (n & 7)):
+                return False
+        return True
+
+    def clear(self):
+        self.bits[:] = bytearray(len(self.bits))
+        self.count   = 0
+
+
+class Dedupe(object):
+    """Remember message ids for about window seconds in fixed memory.
+
+    The most recent ids are held exactly in an LRU, the whole window
+    is covered by a ring of bloom filters each owning window/slices
+    seconds.  A slice is cleared when the ring comes back around to
+    it so ids are forgotten slice by slice, never all at once.
+
+    An id only found in the bloom filters is treated as a duplicate,
+    slices are sized so that is wrong about once in 1/errorRate ids.
+
+        dedupe = Dedupe(window=900)
+        if dedupe.seen(job['id']):
+            return
+    """
+    def __init__(self, window=DEDUPE_WINDOW, slices=DEDUPE_SLICES, capacity=DEDUPE_CAPACITY,
+                       recent=DEDUPE_RECENT, errorRate=DEDUPE_ERROR_RATE):
+        self.window      = window
+        self.sliceLength = float(window) / slices
+        self.slices      = []
+        self.sliceIDs    = []
+        self.recent      = LRUCache(recent)
+        self.hits        = 0    # duplicates found in the LRU
+        self.bloomHits   = 0    # duplicates found only in the bloom filters
+        self.misses      = 0
+
+        for i in range(0, slices):
+            self.slices.append(BloomFilter(capacity, errorRate))
+            self.sliceIDs.append(None)
+
+    def seen(self, key):
+        """Return True if key was already seen within the window.
+        Either way key is remembered from now on.
+        """
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+
+        now     = time.time()
+        sliceID = int(now / self.sliceLength)
+        oldest  = sliceID - len(self.slices)
+
+        # the slice for now is reused once it falls out of the window
+        n     = sliceID % len(self.slices)
+        bloom = self.slices[n]
+        if self.sliceIDs[n] != sliceID:
+            bloom.clear()
+            self.sliceIDs[n] = sliceID
+
+        last = self.recent.get(key)
+
+        if last is not None and now - last < self.window:
+            self.hits += 1
+            result     = True
+        else:
+            result = False
+            for i in range(0, len(self.slices)):
+                if self.sliceIDs[i] > oldest and key in self.slices[i]:
+                    self.bloomHits += 1
+                    result          = True
+                    break
+            if not result:
+                self.misses += 1
+
+        self.recent.put(key, now)
+
+        if key not in bloom:
+            bloom.add(key)
+            if bloom.count == bloom.capacity:
+                log.warning('dedupe slice is full at %d ids, false positives will climb' % bloom.count)
+
+        return result
+
+    def stats(self):
+        return { 'hits':      self.hits,
+                 'bloomHits': self.bloomHits,
+                 'misses':    self.misses,
+                 'recent':    len(self.recent),
+               }
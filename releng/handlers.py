@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" releng - handlers
+
+    handlers for Pulse events registered by event and sub-event,
+    each one counting its calls and timing them
+
+    :copyright: (c) 2012 by Mozilla
+    :license: MPLv2
+
+    Assumes Python v2.6+
+
+    Authors:
+        bear    Mike Taylor <bear@mozilla.com>
+"""
+
+import time
+
+from bisect import bisect_left
+from multiprocessing import get_logger
+
+from releng.constants import METRICS_TIMER
+
+
+log = get_logger()
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100)  # upper bounds, in ms, of the histogram buckets
+
+
+def bucketName(i):
+    if i < len(LATENCY_BUCKETS):
+        return 'upto_%gms' % LATENCY_BUCKETS[i]
+    else:
+        return 'over_%gms' % LATENCY_BUCKETS[-1]
+
+
+class Handler(object):
+    """Base class for event handlers.
+
+    Subclasses define handle(), which Registry.register() checks
+    for.  The handler is called through the registry so every call
+    is counted and timed:
+
+        calls       events handled
+        errors      calls that raised
+        seconds     time spent in handle()
+        slowest     the longest call, in seconds
+        histogram   calls per LATENCY_BUCKETS bucket, the last one
+                    for calls over LATENCY_BUCKETS[-1] ms
+
+    report() returns what was counted since the previous report as
+    metrics, summary() a line for the log.
+    """
+    def __init__(self):
+        self.name      = None   # set by Registry.register()
+        self.calls     = 0
+        self.errors    = 0
+        self.seconds   = 0.0
+        self.slowest   = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.reported  = (0, 0, 0.0, list(self.histogram))
+
+    def __call__(self, *args):
+        t = time.time()
+        try:
+            return self.handle(*args)
+        except:
+            self.errors += 1
+            raise
+        finally:
+            elapsed = time.time() - t
+
+            self.calls   += 1
+            self.seconds += elapsed
+            if elapsed > self.slowest:
+                self.slowest = elapsed
+            self.histogram[bisect_left(LATENCY_BUCKETS, elapsed * 1000)] += 1
+
+    def report(self):
+        calls, errors, seconds, histogram = self.reported
+        group  = 'handler:%s' % self.name
+        result = []
+
+        if self.calls > calls:
+            result.append((METRICS_TIMER, (group, 'calls',  self.calls - calls)))
+            result.append((METRICS_TIMER, (group, 'errors', self.errors - errors)))
+            result.append((METRICS_TIMER, (group, 'ms',     (self.seconds - seconds) * 1000)))
+
+            for i in range(0, len(self.histogram)):
+                if self.histogram[i] > histogram[i]:
+                    result.append((METRICS_TIMER, (group, bucketName(i), self.histogram[i] - histogram[i])))
+
+        self.reported = (self.calls, self.errors, self.seconds, list(self.histogram))
+
+        return result
+
+    def summary(self):
+        if self.calls > 0:
+            avg = self.seconds * 1000 / self.calls
+        else:
+            avg = 0
+
+        buckets = ['%s:%d' % (bucketName(i), self.histogram[i]) for i in range(0, len(self.histogram)) if self.histogram[i] > 0]
+
+        return '%s: %d calls %d errors avg %0.3fms max %0.3fms %s' % (self.name, self.calls, self.errors, avg,
+                                                                     self.slowest * 1000, ' '.join(buckets))
+
+
+class Registry(object):
+    """Handlers keyed by event and sub-event.
+
+    A handler registered for an event with a sub-event of None takes
+    the sub-events of that event that have no handler of their own.
+    Events without any handler are ignored.
+
+        handlers = Registry()
+        handlers.register('build', None,       BuildHandler())
+        handlers.register('build', 'finished', BuildFinished())
+
+        outbound = handlers.dispatch('build', 'finished', item, pipe)
+    """
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, event, subEvent, handler):
+        if not callable(getattr(handler, 'handle', None)):
+            raise ValueError('handler for %s %s does not define handle()' % (event, subEvent))
+
+        # the name ends up in metric names, Graphite does not take spaces
+        if subEvent is None:
+            handler.name = event.replace(' ', '_')
+        else:
+            handler.name = ('%s.%s' % (event, subEvent)).replace(' ', '_')
+
+        self.handlers[(event, subEvent)] = handler
+
+        return handler
+
+    def find(self, event, subEvent=None):
+        handler = self.handlers.get((event, subEvent))
+        if handler is None and subEvent is not None:
+            handler = self.handlers.get((event, None))
+
+        return handler
+
+    def dispatch(self, event, subEvent, *args):
+        """Hand args to the handler for event and sub-event and return
+        its result, an empty list if there is no handler.
+        """
+        handler = self.find(event, subEvent)
+        if handler is None:
+            return []
+        else:
+            return handler(*args)
+
+    def report(self):
+        """Metrics for every handler called since the last report."""
+        result = []
+        for key in sorted(self.handlers):
+            result += self.handlers[key].report()
+
+        return result
+
+    def summary(self):
+        """A log line for every handler that has been called."""
+        return [self.handlers[key].summary() for key in sorted(self.handlers) if self.handlers[key].calls > 0]
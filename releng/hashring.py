@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" releng - hashring
+
+    consistent hashing so the same key keeps landing
+    on the same node as nodes come and go
+
+    :copyright: (c) 2012 by Mozilla
+    :license: MPLv2
+
+    Assumes Python v2.6+
+
+    Authors:
+        bear    Mike Taylor <bear@mozilla.com>
+"""
+
+import struct
+import bisect
+import hashlib
+
+
+VNODES = 160    # points on the ring per node
+
+
+def ringHash(key):
+    return struct.unpack('>I', hashlib.md5(key).digest()[:4])[0]
+
+
+class HashRing(object):
+    """Consistent hash ring with virtual nodes.
+
+    Each node is placed on the ring VNODES times, a key belongs to the
+    first point clockwise from its own hash.  Adding or removing a node
+    only moves the keys that node gains or loses, everything else stays
+    where it was.
+
+        ring = HashRing(['a', 'b'])
+        ring.get('builduid')            # 'a' or 'b'
+        for node in ring.nodes('builduid'):
+            ...                         # every node, preferred first
+    """
+    def __init__(self, nodes=None, vnodes=VNODES):
+        self.vnodes = vnodes
+        self.points = {}    # hash -> node
+        self.hashes = []    # sorted ring points
+        self.members = set()
+
+        if nodes is not None:
+            for node in nodes:
+                self.add(node)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, node):
+        return node in self.members
+
+    def add(self, node):
+        if node in self.members:
+            return
+
+        self.members.add(node)
+
+        for i in range(0, self.vnodes):
+            h = ringHash('%s#%d' % (node, i))
+            if h not in self.points:
+                self.points[h] = node
+                bisect.insort(self.hashes, h)
+
+    def remove(self, node):
+        if node not in self.members:
+            return
+
+        self.members.remove(node)
+
+        self.hashes = []
+        for h in self.points.keys():
+            if self.points[h] == node:
+                del self.points[h]
+            else:
+                self.hashes.append(h)
+        self.hashes.sort()
+
+    def get(self, key):
+        if len(self.hashes) == 0:
+            return None
+
+        i = bisect.bisect(self.hashes, ringHash(key)) % len(self.hashes)
+
+        return self.points[self.hashes[i]]
+
+    def nodes(self, key):
+        """Generate each node once, in ring order starting with the
+        one that owns key - the failover order for that key.
+        """
+        if len(self.hashes) == 0:
+            return
+
+        seen  = set()
+        start = bisect.bisect(self.hashes, ringHash(key))
+        n     = len(self.hashes)
+
+        for i in range(start, start + n):
+            node = self.points[self.hashes[i % n]]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.members):
+                    break
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" releng - isotime
+
+    parsing of the ISO-8601 timestamps Pulse and buildbot use
+    and the date/hour buckets of the dashboards
+
+    :copyright: (c) 2012 by Mozilla
+    :license: MPLv2
+
+    Assumes Python v2.6+
+
+    Authors:
+        bear    Mike Taylor <bear@mozilla.com>
+"""
+
+import time
+import calendar
+
+from collections import namedtuple
+
+from releng.cache import LRUCache
+
+
+TIMESTAMP_CACHE = 4096  # distinct seconds remembered by parseTimestamp()
+
+Timestamp = namedtuple('Timestamp', 'epoch date hour')
+
+_parsed = LRUCache(TIMESTAMP_CACHE)
+
+
+def _parse(ts):
+    if len(ts) < 19 or ts[4] != '-' or ts[7] != '-' or ts[10] not in 'T ' or ts[13] != ':' or ts[16] != ':':
+        raise ValueError('not an ISO-8601 timestamp [%s]' % ts)
+
+    fields = (int(ts[0:4]), int(ts[5:7]), int(ts[8:10]), int(ts[11:13]), int(ts[14:16]), int(ts[17:19]), 0, 0, -1)
+    zone   = ts[19:]
+
+    if zone == '':
+        epoch = time.mktime(fields)
+    elif zone == 'Z':
+        epoch = calendar.timegm(fields)
+    elif zone[0] in '+-' and len(zone) in (3, 5, 6):
+        offset = int(zone[1:3]) * 3600
+        if len(zone) > 3:
+            offset += int(zone[-2:]) * 60
+        if zone[0] == '+':
+            offset = -offset
+        epoch = calendar.timegm(fields) + offset
+    else:
+        raise ValueError('unknown timezone in timestamp [%s]' % ts)
+
+    return Timestamp(epoch, ts[:10], ts[11:13])
+
+def parseTimestamp(ts):
+    """Parse 2012-03-14T15:02:11+01:00 style timestamps.
+
+    Returns a Timestamp of the seconds since the epoch, offset taken
+    into account, and the date and hour strings of the timestamp as
+    written, 2012-03-14 and 15 in the example.  A Z suffix is UTC, no
+    suffix is local time, the date and time can be separated by a
+    space and fractional seconds are kept in epoch.
+
+    Results are cached per distinct second, a burst of events stamped
+    within the same second is parsed once.
+    """
+    fraction = None
+    if len(ts) > 20 and ts[19] == '.':
+        end = 20
+        while end < len(ts) and ts[end].isdigit():
+            end += 1
+        fraction = ts[19:end]
+        ts       = ts[:19] + ts[end:]
+
+    result = _parsed.get(ts)
+    if result is None:
+        result = _parse(ts)
+        _parsed.put(ts, result)
+
+    if fraction is not None:
+        result = result._replace(epoch=result.epoch + float(fraction))
+
+    return result
+
+def timeBucket(epoch=None):
+    """Local date and hour strings for epoch, or for now."""
+    if epoch is None:
+        epoch = time.time()
+    t = time.localtime(epoch)
+    return time.strftime('%Y-%m-%d', t), time.strftime('%H', t)
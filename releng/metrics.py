@@ -76,19 +76,25 @@ class Metric(object):
             except:
                 log.error('unable to connect to graphite at %s:%s' % (self.host, self.port), exc_info=True)
 
-    def check(self):
+    def check(self, force=False):
+        """Send the counts of every interval that has ended, or of
+        every interval when force is set, and return how many counts
+        were sent.  force is for the final flush on shutdown.
+        """
         now     = time.time()
+        flushed = 0
         minutes = time.gmtime(now)[4]
 
         for i in range(0, len(self.intervals)):
             interval = self.intervals[i]
             p        = divmod(minutes, interval)[0]
 
-            if p > self.last[i]:
+            if force or p > self.last[i]:
                 log.debug('gathering counts for interval %d' % interval)
 
                 self.last[i] = p
                 s            = ''
+                pipe         = self.db.pipeline()
                 for metric in self.counts:
                     m = self.counts[metric]
                     v = m['value'][i]
@@ -101,7 +107,8 @@ class Metric(object):
                         hash = 'metrics'
                         if ':' in metric:
                             hash += ':%s' % metric.split(':', 1)[0]
-                        self.db.hset(hash, '%s_%d' % (metric, interval), v)
+                        pipe.hset(hash, '%s_%d' % (metric, interval), v)
+                        flushed += 1
 
                         m['value'][i] = 0
                         m['items'][i] = []
@@ -111,12 +118,15 @@ class Metric(object):
                             m['items'][i + 1].append(v)
 
                 if len(s) > 0:
+                    pipe.execute()
                     self.carbon(s)
             else:
                 # handle case where we loop back to beginning of interval
                 if p < self.last[i]:
                     self.last[i] = p
 
+        return flushed
+
     def count(self, metric, value=1):
         if metric in self.counts:
             self.counts[metric]['value'][0] += value
@@ -127,15 +137,18 @@ class Metric(object):
             for i in range(0, len(self.intervals)):
                 v.append(0)
                 l.append([])
+            v[0] = value
+            l[0].append(value)
             self.counts[metric] = { 'value': v,
                                     'items': l,
                                   }
 
 
 def hashStore(db, hashKey, metric, items):
-    db.hincrby(hashKey, metric)
-    key = metric
-    for item in items:
-        key += ':%s' % item
-        db.hincrby(hashKey, key)
+    with db.pipeline() as pipe:
+        pipe.hincrby(hashKey, metric)
+        key = metric
+        for item in items:
+            key += ':%s' % item
+            pipe.hincrby(hashKey, key)
 
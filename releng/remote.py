@@ -30,6 +30,7 @@ import dns.resolver
 
 from multiprocessing import get_logger
 from . import fetchUrl, runCommand, relative, getPassword
+from .isotime import parseTimestamp
 
 
 log = get_logger()
@@ -730,8 +731,8 @@ class RemoteEnvironment():
                 for line in reversed(lines):
                     if '[Broker,client]' in line:
                         try:
-                            logTS = datetime.datetime.strptime(line[:19], '%Y-%m-%d %H:%M:%S')
-                            logTD = datetime.datetime.now() - logTS
+                            logTS = parseTimestamp(line[:19])
+                            logTD = datetime.timedelta(seconds=time.time() - logTS.epoch)
                         except:
                             log.info('unable to parse the log date', exc_info=True)
                             logTD = None
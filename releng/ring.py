@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" releng - ring
+
+    shared memory ring buffer for handing byte strings
+    between processes
+
+    :copyright: (c) 2012 by Mozilla
+    :license: MPLv2
+
+    Assumes Python v2.6+
+
+    Authors:
+        bear    Mike Taylor <bear@mozilla.com>
+"""
+
+import mmap
+import time
+import struct
+
+from Queue import Empty, Full
+from multiprocessing import RawArray, Lock, Semaphore, get_logger
+
+
+log = get_logger()
+
+RING_SIZE = 8 * 1024 * 1024     # bytes of shared memory per ring
+
+_length = struct.Struct('>I')
+
+# offsets into RingBuffer.state
+_HEAD    = 0    # bytes consumed since the ring was created
+_TAIL    = 1    # bytes produced since the ring was created
+_WAITING = 2    # a producer is waiting for space
+
+
+class RingBuffer(object):
+    """Fixed size FIFO of byte strings in shared memory.
+
+    Records are stored as [length, data] in an anonymous shared mmap
+    and wrap around the end of it.  Nothing is pickled and no feeder
+    thread is involved, put() copies the data into the buffer and
+    get() copies it out as a string.  put() takes anything that has
+    the buffer interface, a zmq.Frame received with copy=False is
+    copied straight from ZeroMQ's memory into the ring.  The ring has
+    to be created before the processes using it are forked.
+
+    Consumers block on a semaphore counting the records in the ring,
+    a producer that finds the ring full blocks on a second one that
+    consumers signal as they free up space.
+
+    Meant for one producer and any number of consumers, pass
+    producers > 1 if more than one process will put() to it.  The
+    get()/put() signatures follow Queue so a ring can stand in for one.
+
+        ring = RingBuffer()
+        ring.put(msg)               # producer
+        msg = ring.get(True, 1)     # consumer, raises Queue.Empty
+    """
+    def __init__(self, size=RING_SIZE, producers=1):
+        self.size      = size
+        self.buffer    = mmap.mmap(-1, size)
+        self.state     = RawArray('L', 3)
+        self.readLock  = Lock()
+        self.records   = Semaphore(0)
+        self.space     = Semaphore(0)
+
+        if producers > 1:
+            self.writeLock = Lock()
+        else:
+            self.writeLock = None
+
+    def used(self):
+        """Bytes of the ring in use, record headers included."""
+        return self.state[_TAIL] - self.state[_HEAD]
+
+    def usage(self):
+        return float(self.used()) / self.size
+
+    def empty(self):
+        return self.used() == 0
+
+    def _write(self, offset, data):
+        start = offset % self.size
+        end   = start + len(data)
+
+        self.buffer.seek(start)
+        if end <= self.size:
+            self.buffer.write(data)
+        else:
+            split = self.size - start
+            self.buffer.write(buffer(data, 0, split))
+            self.buffer.seek(0)
+            self.buffer.write(buffer(data, split))
+
+    def _read(self, offset, length):
+        start = offset % self.size
+        end   = start + length
+
+        if end <= self.size:
+            return self.buffer[start:end]
+        else:
+            return self.buffer[start:self.size] + self.buffer[0:end - self.size]
+
+    def _waitForSpace(self, needed, block, timeout):
+        if not block:
+            raise Full
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        try:
+            while True:
+                # re-checked after setting the flag so a consumer that
+                # freed space in between is not missed
+                self.state[_WAITING] = 1
+                if self.size - self.used() >= needed:
+                    break
+
+                if timeout is None:
+                    self.space.acquire()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0 or not self.space.acquire(True, remaining):
+                        raise Full
+        finally:
+            self.state[_WAITING] = 0
+
+    def put(self, data, block=True, timeout=None, prefix=''):
+        """Add a record, prefix is written in front of data as part
+        of the same record without joining the two.
+        """
+        length = len(prefix) + len(data)
+        needed = _length.size + length
+        if needed > self.size:
+            raise ValueError('record of %d bytes does not fit in a ring of %d bytes' % (length, self.size))
+
+        if self.writeLock is not None:
+            self.writeLock.acquire()
+
+        try:
+            if self.size - self.used() < needed:
+                self._waitForSpace(needed, block, timeout)
+
+            tail  = self.state[_TAIL]
+            start = tail % self.size
+
+            # data is written straight from its own buffer, never
+            # joined to the header
+            if start + needed <= self.size:
+                _length.pack_into(self.buffer, start, length)
+                self.buffer.seek(start + _length.size)
+                if prefix:
+                    self.buffer.write(prefix)
+                self.buffer.write(data)
+            else:
+                self._write(tail, _length.pack(length))
+                self._write(tail + _length.size, prefix)
+                self._write(tail + _length.size + len(prefix), data)
+
+            self.state[_TAIL] = tail + needed
+        finally:
+            if self.writeLock is not None:
+                self.writeLock.release()
+
+        self.records.release()
+
+    def get(self, block=True, timeout=None):
+        if block:
+            if timeout is None:
+                found = self.records.acquire()
+            else:
+                found = self.records.acquire(True, max(0, timeout))
+        else:
+            found = self.records.acquire(False)
+
+        if not found:
+            raise Empty
+
+        self.readLock.acquire()
+        try:
+            head  = self.state[_HEAD]
+            start = head % self.size
+
+            if start + _length.size <= self.size:
+                length = _length.unpack_from(self.buffer, start)[0]
+            else:
+                length = _length.unpack(self._read(head, _length.size))[0]
+
+            data = self._read(head + _length.size, length)
+
+            self.state[_HEAD] = head + _length.size + length
+        finally:
+            self.readLock.release()
+
+        if self.state[_WAITING]:
+            self.space.release()
+
+        return data
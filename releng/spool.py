@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" releng - spool
+
+    durable, append-only on-disk queue of string records
+
+    :copyright: (c) 2012 by Mozilla
+    :license: MPLv2
+
+    Assumes Python v2.6+
+
+    Authors:
+        bear    Mike Taylor <bear@mozilla.com>
+"""
+
+import os
+import json
+import time
+import zlib
+import struct
+
+from multiprocessing import get_logger
+
+
+log = get_logger()
+
+SEGMENT_SIZE  = 64 * 1024 * 1024   # bytes written to a segment before a new one is started
+SYNC_COUNT    = 500                # records appended before an fsync is forced
+SYNC_INTERVAL = 1                  # seconds, see Spool.sync()
+
+_header = struct.Struct('>II')     # record length, crc32 of record
+
+
+def writeCursor(cursorFile, cursor):
+    tmpfile = '%s.tmp' % cursorFile
+    h       = open(tmpfile, 'w')
+    json.dump(list(cursor), h)
+    h.close()
+    os.rename(tmpfile, cursorFile)
+
+class Spool(object):
+    """Durable FIFO of string records.
+
+    Records are appended to numbered segment files as
+
+        [length, crc32, data]
+
+    and the reader position is kept in a small cursor file next to
+    them.  Appends are fsync'd in groups - every SYNC_COUNT records or
+    whenever sync() is called with SYNC_INTERVAL seconds gone by - so
+    a crash can lose at most that window.  Torn or corrupt records are
+    found by their crc when the spool is opened and are cut off.
+
+    Segments the reader has completely committed are deleted.
+
+        spool = Spool('/var/spool/briarpatch', 'pulsebroker')
+        spool.append(msg)
+
+        msgs = spool.read(50)
+        ...
+        spool.commit()      # or spool.rewind() to read them again
+    """
+    def __init__(self, path, name='spool', segmentSize=SEGMENT_SIZE, syncCount=SYNC_COUNT, syncInterval=SYNC_INTERVAL):
+        self.path         = os.path.abspath(path)
+        self.name         = name
+        self.segmentSize  = segmentSize
+        self.syncCount    = syncCount
+        self.syncInterval = syncInterval
+        self.cursorFile   = os.path.join(self.path, '%s.cursor' % name)
+        self.segments     = []
+        self.count        = 0       # records not yet read
+        self.uncommitted  = 0       # records read since the last commit
+        self.readEnds     = []      # position just past each of them
+        self.unsynced     = 0
+        self.lastSync     = time.time()
+        self.cursor       = (0, 0)  # committed (segment, offset)
+        self.position     = (0, 0)  # read (segment, offset)
+        self.reader       = None
+        self.readerID     = None
+        self.writer       = None
+        self.writerID     = None
+        self.writerSize   = 0
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        self.recover()
+
+    def __len__(self):
+        return self.count
+
+    def segmentFile(self, segment):
+        return os.path.join(self.path, '%s_%08d.spool' % (self.name, segment))
+
+    def recover(self):
+        """Load the cursor and walk every remaining segment, counting
+        the unread records and truncating anything that fails its crc.
+        """
+        prefix = '%s_' % self.name
+        for filename in os.listdir(self.path):
+            if filename.startswith(prefix) and filename.endswith('.spool'):
+                try:
+                    self.segments.append(int(filename[len(prefix):-6]))
+                except ValueError:
+                    pass
+        self.segments.sort()
+
+        if os.path.isfile(self.cursorFile):
+            try:
+                segment, offset = json.load(open(self.cursorFile, 'r'))
+                self.cursor     = (int(segment), int(offset))
+            except:
+                log.error('unable to load spool cursor from %s, replaying all segments' % self.cursorFile, exc_info=True)
+
+        for segment in list(self.segments):
+            if segment < self.cursor[0]:
+                self.remove(segment)
+
+        if len(self.segments) > 0 and self.cursor[0] < self.segments[0]:
+            self.cursor = (self.segments[0], 0)
+
+        for segment in self.segments:
+            if segment == self.cursor[0]:
+                offset = self.cursor[1]
+            else:
+                offset = 0
+
+            h = open(self.segmentFile(segment), 'r+b')
+            h.seek(offset)
+
+            while True:
+                good   = h.tell()
+                record = self.readRecord(h)
+                if record is None:
+                    break
+                self.count += 1
+
+            h.seek(0, 2)
+            if h.tell() > good:
+                log.warning('spool segment %d truncated to %d bytes, %d bytes were torn or corrupt' % (segment, good, h.tell() - good))
+                h.truncate(good)
+            h.close()
+
+        if len(self.segments) == 0:
+            self.segments.append(self.cursor[0])
+
+        self.position = self.cursor
+        self.openWriter(self.segments[-1])
+
+        if self.count > 0:
+            log.info('spool %s has %d records pending' % (self.name, self.count))
+
+    def readRecord(self, h):
+        header = h.read(_header.size)
+        if len(header) < _header.size:
+            return None
+
+        length, crc = _header.unpack(header)
+        data        = h.read(length)
+
+        if len(data) < length or (zlib.crc32(data) & 0xffffffff) != crc:
+            return None
+
+        return data
+
+    def openWriter(self, segment):
+        if self.writer is not None:
+            self.sync(force=True)
+            self.writer.close()
+
+        if segment not in self.segments:
+            self.segments.append(segment)
+
+        self.writerID   = segment
+        self.writer     = open(self.segmentFile(segment), 'ab')
+        self.writerSize = self.writer.tell()
+
+    def append(self, data):
+        """Append a record, returns the (segment, offset) just past it -
+        the cursor a reader would commit once it has handled the record.
+        """
+        self.writer.write(_header.pack(len(data), zlib.crc32(data) & 0xffffffff))
+        self.writer.write(data)
+
+        self.writerSize += _header.size + len(data)
+        self.count      += 1
+        self.unsynced   += 1
+
+        result = (self.writerID, self.writerSize)
+
+        if self.writerSize >= self.segmentSize:
+            self.openWriter(self.writerID + 1)
+        elif self.unsynced >= self.syncCount:
+            self.sync(force=True)
+
+        return result
+
+    def flush(self):
+        """Hand appended records to the OS without waiting for an fsync,
+        enough for them to outlive this process but not the machine.
+        """
+        self.writer.flush()
+
+    def sync(self, force=False):
+        """fsync any appended records - only if SYNC_INTERVAL seconds
+        have passed since the last one unless force is set.
+        Meant to be called from a timer so slow trickles still land.
+        """
+        if self.unsynced > 0 and (force or time.time() - self.lastSync >= self.syncInterval):
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+
+            self.unsynced = 0
+            self.lastSync = time.time()
+
+    def read(self, count):
+        """Return up to count records from the read position onwards.
+        The position is not made durable until commit() is called.
+        """
+        result = []
+
+        while len(result) < count and self.count > 0:
+            segment, offset = self.position
+
+            if segment == self.writerID:
+                self.writer.flush()
+
+            if self.readerID != segment:
+                if self.reader is not None:
+                    self.reader.close()
+                self.reader   = open(self.segmentFile(segment), 'rb')
+                self.readerID = segment
+
+            self.reader.seek(offset)
+            record = self.readRecord(self.reader)
+
+            if record is None:
+                later = [s for s in self.segments if s > segment]
+                if len(later) == 0:
+                    log.error('spool %s count is %d but no records were found' % (self.name, self.count))
+                    self.count = 0
+                    break
+                self.position = (later[0], 0)
+            else:
+                result.append(record)
+                self.position     = (segment, self.reader.tell())
+                self.count       -= 1
+                self.uncommitted += 1
+                self.readEnds.append(self.position)
+
+        return result
+
+    def rewind(self, keep=0):
+        """Forget everything read since the last commit() but the
+        first keep records, the rest are read again in order.
+        """
+        keep = min(keep, self.uncommitted)
+
+        self.count      += self.uncommitted - keep
+        self.uncommitted = keep
+        self.readEnds    = self.readEnds[:keep]
+
+        if keep == 0:
+            self.position = self.cursor
+        else:
+            self.position = self.readEnds[-1]
+
+    def commit(self):
+        if self.position == self.cursor:
+            return
+
+        self.cursor      = self.position
+        self.uncommitted = 0
+        self.readEnds    = []
+
+        writeCursor(self.cursorFile, self.cursor)
+
+        for segment in list(self.segments):
+            if segment < self.cursor[0]:
+                self.remove(segment)
+
+    def remove(self, segment):
+        if self.readerID == segment:
+            self.reader.close()
+            self.reader   = None
+            self.readerID = None
+
+        try:
+            os.remove(self.segmentFile(segment))
+        except OSError:
+            log.error('unable to remove spool segment %s' % self.segmentFile(segment), exc_info=True)
+
+        self.segments.remove(segment)
+
+    def close(self):
+        self.sync(force=True)
+        self.writer.close()
+        if self.reader is not None:
+            self.reader.close()
+
+
+class SpoolCursor(object):
+    """Commit the read position of a Spool that is read somewhere else.
+
+    Lets a process that is handed a spool's records, along with the
+    positions append() returned for them, mark them as done without
+    opening the spool itself.  Segments before the committed position
+    are deleted, the next Spool opened on the same files starts there.
+
+        cursor = SpoolCursor('/var/spool/briarpatch', 'journal0')
+        cursor.commit(position)
+    """
+    def __init__(self, path, name='spool'):
+        self.path       = os.path.abspath(path)
+        self.name       = name
+        self.cursorFile = os.path.join(self.path, '%s.cursor' % name)
+        self.cursor     = None
+
+    def commit(self, position):
+        if position == self.cursor:
+            return
+
+        writeCursor(self.cursorFile, position)
+
+        if self.cursor is None or position[0] > self.cursor[0]:
+            prefix = '%s_' % self.name
+            for filename in os.listdir(self.path):
+                if filename.startswith(prefix) and filename.endswith('.spool'):
+                    try:
+                        segment = int(filename[len(prefix):-6])
+                    except ValueError:
+                        continue
+                    if segment < position[0]:
+                        try:
+                            os.remove(os.path.join(self.path, filename))
+                        except OSError:
+                            log.error('unable to remove spool segment %s' % filename, exc_info=True)
+
+        self.cursor = position
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" releng - timeindex
+
+    time range queries over the sorted sets bpServer files builds,
+    jobs and changes in, scored by epoch, and their trimming
+
+    :copyright: (c) 2012 by Mozilla
+    :license: MPLv2
+
+    Assumes Python v2.6+
+
+    Authors:
+        bear    Mike Taylor <bear@mozilla.com>
+"""
+
+import time
+
+from releng.constants import INDEX_BUILD, INDEX_JOB, INDEX_CHANGE
+
+
+INDEX_DAYS = 30     # days of builds, jobs and changes the indexes keep
+
+
+def between(db, index, start=None, end=None, offset=None, count=None):
+    """Keys of index scored from start, inclusive, to end, exclusive,
+    oldest first.  Either end of the range can be left open with None.
+
+    Jobs are scored by when they started, or when they finished if
+    their start was not seen, builds by the score of the job of
+    theirs indexed last and changes by when they were made.
+    """
+    if start is None:
+        start = '-inf'
+    if end is None:
+        end = '+inf'
+    else:
+        end = '(%r' % float(end)
+
+    return db.zrangebyscore(index, start, end, offset, count)
+
+def countBetween(db, index, start=None, end=None):
+    """How many keys of index between() would return."""
+    if start is None:
+        start = '-inf'
+    if end is None:
+        end = '+inf'
+    else:
+        end = '(%r' % float(end)
+
+    return db.zcount(index, start, end)
+
+def buildsBetween(db, start=None, end=None):
+    return between(db, INDEX_BUILD, start, end)
+
+def jobsBetween(db, start=None, end=None):
+    return between(db, INDEX_JOB, start, end)
+
+def changesBetween(db, start=None, end=None):
+    return between(db, INDEX_CHANGE, start, end)
+
+def bucketRange(date, hour=None):
+    """Start and end epochs of a local YYYY-MM-DD date, or of one hour
+    of it, the buckets timeBucket() names.
+    """
+    y, m, d = [int(v) for v in date.split('-')]
+
+    if hour is None:
+        start = time.mktime((y, m, d,     0, 0, 0, 0, 0, -1))
+        end   = time.mktime((y, m, d + 1, 0, 0, 0, 0, 0, -1))
+    else:
+        start = time.mktime((y, m, d, int(hour), 0, 0, 0, 0, -1))
+        end   = start + 3600
+
+    return start, end
+
+def trimBefore(db, end):
+    """Drop everything scored before end from the build, job and
+    change indexes.  Returns how many keys each of them lost, the
+    hashes of the builds, jobs and changes are left alone.
+    """
+    end = '(%r' % float(end)
+
+    with db.pipeline() as pipe:
+        for index in (INDEX_BUILD, INDEX_JOB, INDEX_CHANGE):
+            pipe.zremrangebyscore(index, '-inf', end)
+
+    return pipe.results
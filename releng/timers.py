@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" releng - timers
+
+    a hashed timer wheel so event loops can block until
+    the next timer is actually due
+
+    :copyright: (c) 2012 by Mozilla
+    :license: MPLv2
+
+    Assumes Python v2.6+
+
+    Authors:
+        bear    Mike Taylor <bear@mozilla.com>
+"""
+
+import time
+import math
+
+from multiprocessing import get_logger
+
+
+log = get_logger()
+
+
+class TimerWheel(object):
+    """Hashed timer wheel.
+
+    Timers are dropped into one of `slots` buckets by the tick they
+    expire on, each tick being `tick` seconds long.  Scheduling and
+    cancelling are O(1) - cancelled timers are just flagged and are
+    discarded when their bucket comes around.
+
+        wheel = TimerWheel()
+        timer = wheel.schedule(30, callback, arg1, arg2)
+        wheel.cancel(timer)
+
+        poller.poll(wheel.timeout())
+        wheel.advance()
+    """
+    def __init__(self, tick=1.0, slots=256):
+        self.tick    = float(tick)
+        self.buckets = []
+        self.count   = 0
+        self.current = int(time.time() / self.tick)
+
+        for i in range(0, slots):
+            self.buckets.append([])
+
+    def schedule(self, delay, callback, *args):
+        tick = int(math.ceil((time.time() + delay) / self.tick))
+        if tick <= self.current:
+            tick = self.current + 1
+
+        # [ tick, callback, args, active ]
+        timer = [tick, callback, args, True]
+
+        self.buckets[tick % len(self.buckets)].append(timer)
+        self.count += 1
+
+        return timer
+
+    def cancel(self, timer):
+        if timer is not None and timer[3]:
+            timer[3]    = False
+            self.count -= 1
+
+    def timeout(self):
+        """Return how many seconds until the next active timer is due,
+        or None if there are no timers at all.
+        """
+        if self.count == 0:
+            return None
+
+        n = len(self.buckets)
+        for i in range(1, n + 1):
+            tick = self.current + i
+            for timer in self.buckets[tick % n]:
+                if timer[3] and timer[0] == tick:
+                    return max(0.0, (tick * self.tick) - time.time())
+
+        # everything is more than one rotation away
+        return max(0.0, ((self.current + n) * self.tick) - time.time())
+
+    def advance(self):
+        """Fire every timer that has come due, returns how many fired.
+        """
+        target = int(time.time() / self.tick)
+        due    = []
+
+        if target > self.current:
+            n = len(self.buckets)
+            for i in range(1, min(target - self.current, n) + 1):
+                slot   = (self.current + i) % n
+                bucket = []
+                for timer in self.buckets[slot]:
+                    if not timer[3]:
+                        continue
+                    if timer[0] <= target:
+                        due.append(timer)
+                    else:
+                        bucket.append(timer)
+                self.buckets[slot] = bucket
+
+            self.current = target
+
+        for timer in due:
+            if timer[3]:
+                timer[3]    = False
+                self.count -= 1
+                try:
+                    timer[1](*timer[2])
+                except:
+                    log.error('error raised by timer callback', exc_info=True)
+
+        return len(due)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" releng - wire
+
+    encoding of the jobs and metrics that travel between
+    PulseBroker, bpServer and bpMetrics
+
+    :copyright: (c) 2012 by Mozilla
+    :license: MPLv2
+
+    Assumes Python v2.6+
+
+    Two formats are available:
+
+        json        always available, what every peer understands
+        msgpack1    msgpack with the fixed job field names and the
+                    known metric groups replaced by small integers,
+                    only available if the msgpack module is installed
+
+    Peers agree on a format when they first ping each other: the
+    pinging side sends formats() and the other side answers with the
+    first one it also supports, see negotiate().  Decoding does not
+    need to know the format - a json job or metric list always starts
+    with '{' or '[' which msgpack never does.
+
+    A broker also offers WIRE_KEYS with its ping.  A server that
+    understands it answers with WIRE_KEYS after the format and is then
+    sent its jobs as 'keyed' requests, the routing key of each job in
+    a frame of their own, so it can pick a worker without decoding the
+    job.  Peers that do not know it never offer or answer it.
+
+    Only the group of METRICS_COUNT items is interned as that is the
+    one place where the first value is known to be a group name.
+
+    The interning tables below are part of the msgpack1 format, any
+    change to them needs a new format name.
+
+    Authors:
+        bear    Mike Taylor <bear@mozilla.com>
+"""
+
+import json
+
+from multiprocessing import get_logger
+
+from releng.constants import METRICS_COUNT
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+log = get_logger()
+
+WIRE_JSON    = 'json'
+WIRE_MSGPACK = 'msgpack1'
+WIRE_KEYS    = 'keys'       # not a format, routing keys are sent with the jobs
+
+_jobKeys = ('master', 'pulse_key', 'time', 'id', 'slave', 'event', 'pulse',
+            'payload', 'build', 'change', 'properties', 'results', 'revision',
+            'comments', 'project', 'branch',
+           )
+
+_metricGroups = ('metrics', 'connect:slave', 'disconnect:slave', 'build',
+                 'build:started:slave', 'build:started:master', 'build:started:branch', 'build:started:product',
+                 'build:finished:slave', 'build:finished:master', 'build:finished:branch', 'build:finished:product',
+                )
+
+_jobIntern    = dict([(k, i) for i, k in enumerate(_jobKeys)])
+_metricIntern = dict([(k, i) for i, k in enumerate(_metricGroups)])
+
+
+def formats():
+    """Formats this process can speak, most preferred first."""
+    if msgpack is None:
+        return [WIRE_JSON]
+    else:
+        return [WIRE_MSGPACK, WIRE_JSON]
+
+def preferred():
+    return formats()[0]
+
+def negotiate(offered):
+    """Pick the first of the offered formats we also support.
+    offered is the space separated list a peer sent with its ping.
+    """
+    supported = formats()
+    for fmt in offered.split():
+        if fmt in supported:
+            return fmt
+    return WIRE_JSON
+
+def keysOffered(offered):
+    """Whether a peer's ping offered to take routing keys with its jobs."""
+    return WIRE_KEYS in offered.split()
+
+def isJSON(data):
+    return data[:1] in ('{', '[')
+
+def _internJob(job):
+    result = {}
+    for key, value in job.iteritems():
+        if isinstance(value, dict):
+            value = _internJob(value)
+        result[_jobIntern.get(key, key)] = value
+    return result
+
+def _externJob(job):
+    result = {}
+    for key, value in job.iteritems():
+        if isinstance(value, dict):
+            value = _externJob(value)
+        if isinstance(key, int):
+            key = _jobKeys[key]
+        result[key] = value
+    return result
+
+def encodeJob(job, fmt=WIRE_JSON):
+    if fmt == WIRE_MSGPACK:
+        return msgpack.packb(_internJob(job))
+    else:
+        return json.dumps(job)
+
+def decodeJob(data):
+    if isJSON(data):
+        return json.loads(data)
+    else:
+        return _externJob(msgpack.unpackb(data))
+
+def transcodeJob(data, fmt):
+    """Re-encode data unless it already is in fmt."""
+    if isJSON(data) == (fmt == WIRE_JSON):
+        return data
+    else:
+        return encodeJob(decodeJob(data), fmt)
+
+def jobBuilduid(job):
+    """The builduid of the build or change a job belongs to, or None."""
+    if 'pulse' in job:
+        payload = job['pulse']['payload']
+        for section in ('build', 'change'):
+            if section in payload:
+                for p in payload[section].get('properties', []):
+                    if p[0] == 'builduid':
+                        return p[1]
+    return None
+
+def routeKey(job):
+    """The key a job is routed on: the builduid of the build or change
+    it belongs to, falling back to the slave and then the master.
+    PulseBroker picks a server with it and bpServer a worker.
+    """
+    result = jobBuilduid(job)
+
+    if result is None:
+        result = job.get('slave', job['master'])
+
+    if isinstance(result, unicode):
+        result = result.encode('utf-8')
+
+    return str(result)
+
+def encodeMetrics(items, fmt=WIRE_JSON):
+    if fmt == WIRE_MSGPACK:
+        packed = []
+        for metric, data in items:
+            if metric == METRICS_COUNT and data[0] in _metricIntern:
+                data = [_metricIntern[data[0]]] + list(data[1:])
+            packed.append((metric, data))
+        return msgpack.packb(packed)
+    else:
+        return json.dumps(items)
+
+def decodeMetrics(data):
+    if isJSON(data):
+        return json.loads(data)
+    else:
+        result = []
+        for metric, item in msgpack.unpackb(data):
+            if metric == METRICS_COUNT and isinstance(item[0], int):
+                item[0] = _metricGroups[item[0]]
+            result.append((metric, item))
+        return result
+
+def transcodeMetrics(data, fmt):
+    if isJSON(data) == (fmt == WIRE_JSON):
+        return data
+    else:
+        return encodeMetrics(decodeMetrics(data), fmt)